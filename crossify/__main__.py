@@ -1,25 +1,18 @@
+import cProfile
+from functools import partial, wraps
+import json
+
 import click
-import geopandas as gpd
-from os import path
-import osmnx as ox
-import numpy as np
 
-from . import crossings, intersections, io, validators
-from .opensidewalks import make_links
+from .metrics import Metrics
+from .pipeline import configure_osmnx, core, core_tiled
 
+# Modules that depend on geopandas, osmnx, etc. are imported by the functions
+# that need them, so that starting the application (e.g. for --help) is fast.
 
-# Have to add extra layers
-# FIXME: 'layer' is not correctly processed in osmnx. Other tags get turned
-# into arrays if the ways get combined. Also, ways shouldn't be combined if
-# they they are on different layers anyways, so may need to drop osmnx /
-# simplify ourselves
-USEFUL_TAGS_PATH = ['access', 'area', 'bridge', 'est_width', 'highway',
-                    'landuse', 'lanes', 'oneway', 'maxspeed', 'name', 'ref',
-                    'service', 'tunnel', 'width', 'layer']
 
-ox.utils.config(cache_folder=path.join(path.dirname(__file__), '../cache'),
-                useful_tags_path=USEFUL_TAGS_PATH,
-                use_cache=True)
+# Same as crossings.SEARCH_MODES
+SEARCH_MODES = ['exhaustive', 'bounded', 'compare']
 
 # Groups:
 #   - Download all data from OSM bounding box, produce OSM file
@@ -40,134 +33,393 @@ def crossify():
     pass
 
 
+def check_outfile(ctx, param, value):
+    from . import io
+
+    # Fail before doing any work if the output format isn't supported
+    try:
+        io.output_format(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
+def crossing_options(command):
+    # Options shared by the commands that draw crossings. Apart from
+    # --street-cache-size and --cluster-radius, they're passed on to
+    # crossings.make_crossings.
+    options = [
+        click.option('--workers', default=1, type=int,
+                     help='Number of processes to use when drawing '
+                          'crossings.'),
+        click.option('--search', default='exhaustive',
+                     type=click.Choice(SEARCH_MODES),
+                     help='Crossing search strategy. \'compare\' runs both '
+                          'and warns where they differ.'),
+        click.option('--dedupe-tolerance', type=float, default=None,
+                     help='Also remove crossings whose endpoints are within '
+                          'this distance (meters) of another crossing.'),
+        click.option('--street-cache-size', type=int, default=None,
+                     help='Size cap (megabytes) of the cache of '
+                          'preprocessed street networks. 0 disables it. '
+                          'Default: 1024.'),
+        click.option('--cluster-radius', type=float, default=0,
+                     help='Treat intersections within this distance '
+                          '(meters) of each other, such as the two sides of '
+                          'a divided road, as one complex intersection. 0 '
+                          'disables it.')
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def tile_options(command):
+    options = [
+        click.option('--tile-size', type=float, default=None,
+                     help='Process the area in square tiles of this size '
+                          '(meters), streaming crossings to the output.'),
+        click.option('--tile-overlap', type=float, default=200,
+                     help='Overlap between neighboring tiles (meters).')
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def metrics_options(command):
+    # Record metrics for the stages of the command and optionally profile
+    # it. The command receives the Metrics as its 'metrics' argument.
+    @wraps(command)
+    def wrapper(profile, metrics_out, **kwargs):
+        metrics = Metrics()
+        if profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            command(metrics=metrics, **kwargs)
+        finally:
+            if profile:
+                profiler.disable()
+                profiler.dump_stats(profile)
+            if metrics_out:
+                metrics.write(metrics_out)
+
+    options = [
+        click.option('--profile', default=None,
+                     help='Write cProfile statistics of the run to this '
+                          'file. Worker processes aren\'t profiled.'),
+        click.option('--metrics-out', default=None,
+                     help='Write the time, memory use and item counts of '
+                          'each stage, and crossing search counters, to '
+                          'this file as JSON.')
+    ]
+    for option in reversed(options):
+        wrapper = option(wrapper)
+    return wrapper
+
+
 @crossify.command()
 @click.argument('sidewalks_in')
-@click.argument('outfile')
-def from_file(sidewalks_in, outfile):
-    #
-    # Read, fetch, and standardize data
-    #
-
-    # Note: all are converted to WGS84 by default
-    sidewalks = io.read_sidewalks(sidewalks_in)
-    core(sidewalks, outfile)
+@click.argument('outfile', callback=check_outfile)
+@crossing_options
+@tile_options
+@click.option('--state', 'state_path', default=None,
+              help='State file from a previous run. Only intersections '
+                   'whose streets or sidewalks changed are recomputed, and '
+                   'the file is updated for the next run.')
+@metrics_options
+def from_file(sidewalks_in, outfile, tile_size, tile_overlap, state_path,
+              metrics, **options):
+    from . import io, store
+
+    if store.is_prepared(sidewalks_in):
+        if tile_size:
+            raise click.UsageError('--tile-size can\'t be used with prepared '
+                                   'sidewalks')
+        with metrics.stage('open_sidewalks') as stage:
+            sidewalks = store.open_prepared(sidewalks_in)
+            stage['items'] = len(sidewalks.ids)
+        core(sidewalks, outfile, state_path=state_path, metrics=metrics,
+             **options)
+        return
 
+    if tile_size:
+        if state_path:
+            raise click.UsageError('--state can\'t be used with --tile-size')
+        read_tile = partial(io.read_sidewalks_bbox, sidewalks_in)
+        bounds = io.sidewalks_bounds(sidewalks_in)
+        core_tiled(read_tile, bounds, outfile, tile_size, tile_overlap,
+                   metrics=metrics, **options)
+        return
 
-@crossify.command()
-@click.argument('west')
-@click.argument('south')
-@click.argument('east')
-@click.argument('north')
-@click.argument('outfile')
-@click.option('--opensidewalks', is_flag=True)
-def osm_bbox(west, south, east, north, outfile, opensidewalks):
     #
     # Read, fetch, and standardize data
     #
 
-    # Note: all are converted to WGS84 by default
-    sidewalks = io.fetch_sidewalks(west, south, east, north)
-    core(sidewalks, outfile, opensidewalks=opensidewalks)
+    # Sidewalks stay in their own coordinate system until they're projected
+    # for drawing crossings
+    with metrics.stage('read_sidewalks') as stage:
+        sidewalks = io.read_sidewalks(sidewalks_in)
+        stage['items'] = len(sidewalks)
+    core(sidewalks, outfile, state_path=state_path, metrics=metrics,
+         **options)
 
 
-def core(sidewalks, outfile, opensidewalks=False):
-    #
-    # Read, fetch, and standardize data
-    #
+@crossify.command()
+@click.argument('sidewalks_in')
+@click.argument('prepared_out')
+@click.option('--cell-size', type=float, default=None,
+              help='Size of the spatial index cells (meters). Default: 50.')
+def prepare(sidewalks_in, prepared_out, cell_size):
+    # Read, validate, project and index sidewalks once, so that from_file
+    # and batch can memory-map them
+    from . import io, projection, store
+
+    click.echo('Reading sidewalks...', nl=False)
+    sidewalks = io.read_sidewalks(sidewalks_in)
+    click.echo('Done')
 
-    # Note: all are converted to WGS84 by default
-    click.echo('Fetching street network from OpenStreetMap...', nl=False)
+    click.echo('Indexing sidewalks...', nl=False)
+    extent = projection.lonlat_bounds(sidewalks.total_bounds, sidewalks.crs)
+    utm = projection.utm_crs_for_bounds(extent)
+    prepared = store.from_frame(sidewalks, to_crs=utm, extent=extent,
+                                cell_size=cell_size or store.CELL_SIZE)
+    click.echo('Done')
 
-    G_streets = io.fetch_street_graph(sidewalks)
+    try:
+        store.write(prepared, prepared_out)
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
-    click.echo('Done')
+    click.echo('Wrote {} sidewalks'.format(len(prepared.ids)))
 
-    # Work in UTM
-    sidewalks_u = ox.projection.project_gdf(sidewalks)
 
-    # Extract street graph
-    click.echo('Generating street graph...', nl=False)
+@crossify.command()
+@click.argument('west')
+@click.argument('south')
+@click.argument('east')
+@click.argument('north')
+@click.argument('outfile', callback=check_outfile)
+@click.option('--opensidewalks', is_flag=True)
+@crossing_options
+@tile_options
+@click.option('--concurrent-fetch', is_flag=True,
+              help='Fetch streets and sidewalks at the same time, in tiles, '
+                   'caching every response.')
+@click.option('--fetch-tile-size', type=float, default=5000,
+              help='Size of the tiles fetched with --concurrent-fetch '
+                   '(meters).')
+@click.option('--max-requests', type=int, default=4,
+              help='Number of requests in flight with --concurrent-fetch.')
+@click.option('--overpass-url', default=None,
+              help='Overpass API interpreter to use with --concurrent-fetch.')
+@metrics_options
+def osm_bbox(west, south, east, north, outfile, opensidewalks, tile_size,
+             tile_overlap, concurrent_fetch, fetch_tile_size, max_requests,
+             overpass_url, metrics, **options):
+    from . import io
+
+    bounds = [float(x) for x in (west, south, east, north)]
+
+    if tile_size:
+        if concurrent_fetch:
+            raise click.UsageError('--concurrent-fetch can\'t be used with '
+                                   '--tile-size')
+        core_tiled(io.fetch_sidewalks, bounds, outfile, tile_size,
+                   tile_overlap, opensidewalks=opensidewalks,
+                   metrics=metrics, **options)
+        return
 
-    G_streets_u = ox.projection.project_graph(G_streets)
-    # Fix the layer value
-    for u, v, k, l in G_streets_u.edges(keys=True, data='layer', default=0):
-        layer = validators.transform_layer(l)
-        G_streets_u.edges[u, v, k]['layer'] = layer
+    if concurrent_fetch:
+        from . import fetch
 
-    click.echo('Done')
+        click.echo('Fetching streets and sidewalks from OpenStreetMap...',
+                   nl=False)
 
-    # Extract streets from streets graph
-    click.echo('Extracting geospatial data from street graph...', nl=False)
+        configure_osmnx()
+        with metrics.stage('fetch') as stage:
+            G_streets, sidewalks = fetch.fetch_area(
+                bounds, tile_size=fetch_tile_size,
+                url=overpass_url or fetch.OVERPASS_URL,
+                max_requests=max_requests)
+            stage['items'] = len(sidewalks)
 
-    # Get the undirected street graph
-    G_undirected_u = ox.save_load.get_undirected(G_streets_u)
-    streets = ox.save_load.graph_to_gdfs(G_undirected_u, nodes=False,
-                                         edges=True)
-    streets.crs = sidewalks_u.crs
+        click.echo('Done')
 
-    click.echo('Done')
+        core(sidewalks, outfile, opensidewalks=opensidewalks,
+             G_streets=G_streets, metrics=metrics, **options)
+        return
 
     #
-    # Isolate intersections that need crossings (degree > 3), group with
-    # their streets (all pointing out from the intersection)
+    # Read, fetch, and standardize data
     #
-    click.echo('Isolating street intersections...', nl=False)
 
-    ixns = intersections.group_intersections(G_streets_u)
+    # Sidewalks are fetched in lon-lat. They're projected once, to the UTM
+    # zone picked from their bounds, when crossings are drawn.
+    with metrics.stage('fetch_sidewalks') as stage:
+        sidewalks = io.fetch_sidewalks(west, south, east, north)
+        stage['items'] = len(sidewalks)
+    core(sidewalks, outfile, opensidewalks=opensidewalks, metrics=metrics,
+         **options)
 
-    click.echo('Done')
+
+@crossify.command()
+@click.argument('extract')
+@click.argument('outfile', callback=check_outfile)
+@click.option('--bbox', nargs=4, type=float, default=None,
+              help='Only use the part of the extract within this west, '
+                   'south, east, north bounding box.')
+@click.option('--opensidewalks', is_flag=True)
+@crossing_options
+@click.option('--state', 'state_path', default=None,
+              help='State file from a previous run. Only intersections '
+                   'whose streets or sidewalks changed are recomputed, and '
+                   'the file is updated for the next run.')
+@metrics_options
+def osm_file(extract, outfile, bbox, opensidewalks, state_path, metrics,
+             **options):
+    from . import io
 
     #
-    # Draw crossings using the intersection + street + sidewalk info
+    # Read data from a local OSM extract (.osm.pbf or .osm) rather than
+    # fetching it
     #
-    click.echo('Drawing crossings...', nl=False)
+    click.echo('Reading OSM extract...', nl=False)
 
-    # Implied default value of 'layer' is 0, but it might be explicitly
-    # described in some cases. Don't want to accidentally compare 'nan' to 0
-    # and get 'False' when those are implicitly true in OSM
-    validators.standardize_layer(sidewalks_u)
+    configure_osmnx()
 
-    st_crossings = crossings.make_crossings(ixns, sidewalks_u)
-    if st_crossings is None:
-        click.echo('Failed to make any crossings!')
-        return
-
-    if 'layer' in sidewalks_u.columns:
-        keep_cols = ['geometry', 'layer']
-    else:
-        keep_cols = ['geometry']
-    st_crossings = gpd.GeoDataFrame(st_crossings[keep_cols])
-    st_crossings.crs = sidewalks_u.crs
+    with metrics.stage('read_extract') as stage:
+        G_streets, sidewalks = io.read_osm_extract(extract,
+                                                   bounds=bbox or None)
+        stage['items'] = len(sidewalks)
 
     click.echo('Done')
 
-    #
-    # Schema correction stuff
-    #
+    if sidewalks.empty:
+        click.echo('No sidewalks found in the extract!')
+        return
 
-    st_crossings['highway'] = 'footway'
-    st_crossings['footway'] = 'crossing'
+    core(sidewalks, outfile, opensidewalks=opensidewalks,
+         state_path=state_path, G_streets=G_streets, metrics=metrics,
+         **options)
 
-    #
-    # Write to file
-    #
-
-    click.echo('Writing to file...', nl=False)
 
-    if opensidewalks:
-        # If the OpenSidewalks schema is desired, transform the data to OSM
-        # schema
-        st_crossings, sw_links = make_links(st_crossings, offset=1)
-        st_crossings['layer'] = st_crossings['layer'].replace(0, np.nan)
-        sw_links['layer'] = sw_links['layer'].replace(0, np.nan)
+@crossify.command()
+@click.option('--size', type=int, multiple=True,
+              help='Approximate number of intersections in the synthetic '
+                   'city. Can be repeated. Default: 100, 1000 and 10000.')
+@click.option('--skew', type=float, default=0.2,
+              help='Shear of the street grid, in blocks per row.')
+@click.option('--divided', type=int, default=4,
+              help='Make every nth row of streets a divided road. 0 for '
+                   'none.')
+@click.option('--workers', default=1, type=int,
+              help='Number of processes to use when drawing crossings.')
+@click.option('--search', default='exhaustive',
+              type=click.Choice(SEARCH_MODES))
+@click.option('--cluster-radius', type=float, default=0,
+              help='Cluster intersections within this distance (meters).')
+@click.option('--output', default=None,
+              help='Write the results (JSON) to this file instead of stdout.')
+@click.option('--startup-only', is_flag=True,
+              help='Only measure how long the application takes to start, '
+                   'and to run on a small local file.')
+@click.option('--max-startup', type=float, default=None,
+              help='Fail if starting the application takes longer than this '
+                   '(seconds), or loads heavy modules such as geopandas.')
+def benchmark(size, skew, divided, workers, search, cluster_radius, output,
+              startup_only, max_startup):
+    from . import benchmark as bench
+
+    # Time each stage of the pipeline on synthetic street grids, so that
+    # performance can be compared between versions
+    results = {}
+    if startup_only or max_startup is not None:
+        click.echo('Measuring startup time...', nl=False, err=True)
+        startup = bench.startup_times()
+        startup['local_run_seconds'] = bench.local_run_time()
+        results['startup'] = startup
+        click.echo('Done', err=True)
+
+    runs = []
+    if not startup_only:
+        for n in size or [100, 1000, 10000]:
+            click.echo('Benchmarking {} intersections...'.format(n),
+                       nl=False, err=True)
+            runs.append(bench.run_benchmark(n, skew=skew, divided=divided,
+                                            workers=workers, search=search,
+                                            cluster_radius=cluster_radius))
+            click.echo('Done', err=True)
+    results['runs'] = runs
+
+    dumped = json.dumps(results, indent=2)
+    if output is None:
+        click.echo(dumped)
+    else:
+        with open(output, 'w') as f:
+            f.write(dumped + '\n')
 
-        base, ext = path.splitext(outfile)
-        sw_links_outfile = '{}_links{}'.format(base, ext)
-        io.write_sidewalk_links(sw_links, sw_links_outfile)
+    if max_startup is not None:
+        if startup['heavy_modules']:
+            raise click.ClickException(
+                'Startup loads {}'.format(', '.join(startup['heavy_modules'])))
+        slowest = max(startup['seconds'].values())
+        if slowest > max_startup:
+            raise click.ClickException(
+                'Startup took {:.2f}s, more than {:.2f}s'.format(slowest,
+                                                                 max_startup))
 
-    io.write_crossings(st_crossings, outfile)
 
-    click.echo('Done')
+@crossify.command()
+@click.argument('manifest')
+@click.option('--jobs', default=1, type=int,
+              help='Number of regions to process at once.')
+@click.option('--summary', default=None,
+              help='Write a JSON report of every region to this file.')
+@crossing_options
+def batch(manifest, jobs, summary, **options):
+    # Process every region of a manifest (see crossify.batch), continuing past
+    # failures
+    from . import batch as batch_module
+
+    if jobs > 1 and options['workers'] > 1:
+        raise click.UsageError('--workers can\'t be used with --jobs')
+
+    try:
+        regions = batch_module.read_manifest(manifest)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='manifest')
+    for region in regions:
+        check_outfile(None, None, region['outfile'])
+
+    results = []
+    for result in batch_module.run_batch(regions, jobs=jobs, **options):
+        results.append(result)
+        click.echo('[{}/{}] {} {} ({:.1f}s, {} crossings)'.format(
+            len(results), len(regions), result['status'], result['outfile'],
+            result['seconds'], result['crossings']))
+        if result['error']:
+            click.echo(result['error'], err=True)
+
+    results.sort(key=lambda result: result['region'])
+    failed = [result for result in results if result['status'] == 'failed']
+
+    if summary is not None:
+        with open(summary, 'w') as f:
+            json.dump({
+                'regions': len(results),
+                'failed': len(failed),
+                'crossings': sum(result['crossings'] for result in results),
+                'seconds': sum(result['seconds'] for result in results),
+                'results': results
+            }, f, indent=2)
+            f.write('\n')
+
+    click.echo('{} of {} regions succeeded'.format(len(results) - len(failed),
+                                                   len(results)))
+    if failed:
+        raise click.ClickException('{} regions failed'.format(len(failed)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+'''Library interface: draw crossings from street and sidewalk data that is
+already in memory.
+
+Unlike the command line application, nothing here fetches data, writes files,
+prints or sets global configuration, so it can be called repeatedly in one
+process, e.g. once per area of a tiled job.'''
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+
+from . import crossings, intersections, projection, store
+from .opensidewalks import make_links
+
+
+def draw_crossings(sidewalks, streets, opensidewalks=False, cluster_radius=0,
+                   **options):
+    '''Draw street crossings between sidewalks.
+
+    :param sidewalks: Sidewalk LineStrings, with an optional 'layer' column.
+                      If they have a coordinate reference system, crossings
+                      are drawn in the local UTM zone. Otherwise they must
+                      already be in a projected, meter-based one.
+    :type sidewalks: geopandas.GeoDataFrame
+    :param streets: Either street LineStrings split at intersections, with an
+                    optional 'layer' column, or a street graph like the ones
+                    made by osmnx, with node 'x' and 'y' attributes and an
+                    optional 'crs' graph attribute (lon-lat by default).
+    :type streets: geopandas.GeoDataFrame or networkx.MultiDiGraph
+    :param opensidewalks: Follow the OpenSidewalks schema: trim crossings
+                          and return the links that join them to the
+                          sidewalks.
+    :type opensidewalks: bool
+    :param cluster_radius: Treat intersections within this distance (meters)
+                           of each other as one complex intersection. 0
+                           disables it.
+    :type cluster_radius: float
+    :param options: Passed on to crossings.make_crossings, e.g. workers or
+                    search.
+    :returns: The crossings and, with opensidewalks, the links (otherwise
+              None), in the coordinate reference system of the sidewalks.
+    :rtype: tuple of geopandas.GeoDataFrame
+
+    '''
+    crs = sidewalks.crs
+    sidewalks = sidewalks[sidewalks.type == 'LineString']
+    if not len(sidewalks):
+        raise ValueError('No LineStrings in sidewalks dataset: are they '
+                         'MultiLineStrings?')
+
+    # Sidewalks are projected once, as they're indexed
+    if crs:
+        utm = projection.utm_crs_for(sidewalks)
+    else:
+        utm = None
+    sidewalks_u = store.from_frame(sidewalks, to_crs=utm)
+
+    if isinstance(streets, gpd.GeoDataFrame):
+        streets = streets[streets.type == 'LineString']
+        if utm is not None:
+            streets = projection.project_frame(streets, utm)
+        G_streets_u = street_graph(streets)
+    elif utm is not None:
+        G_streets_u = projection.project_graph(streets, utm)
+    else:
+        G_streets_u = streets
+
+    ixns = intersections.group_intersections(G_streets_u)
+    if cluster_radius:
+        labels = intersections.cluster_intersections(ixns, cluster_radius)
+        ixns = intersections.merge(ixns, labels)
+
+    st_crossings = crossings.make_crossings(ixns, sidewalks_u,
+                                            as_frame=False, **options)
+    st_crossings = st_crossings.to_frame(sidewalks_u.crs, columns=['layer'])
+
+    st_crossings, sw_links = osm_schema(st_crossings, opensidewalks)
+
+    if utm is not None:
+        st_crossings = projection.project_frame(st_crossings, crs)
+        if sw_links is not None:
+            sw_links = projection.project_frame(sw_links, crs)
+
+    return st_crossings, sw_links
+
+
+def street_graph(streets, precision=1e-3):
+    '''Make a street graph from street LineStrings. Streets whose endpoints
+    are within the same grid cell of size `precision` meet at a node.
+
+    :param streets: Street LineStrings split at intersections, with an
+                    optional 'layer' column.
+    :type streets: geopandas.GeoDataFrame
+    :returns: The street graph, with one edge per street.
+    :rtype: networkx.MultiDiGraph
+
+    '''
+    G = nx.MultiDiGraph(crs=streets.crs)
+
+    if 'layer' in streets.columns:
+        layers = streets['layer']
+    else:
+        layers = [0] * len(streets)
+
+    node_ids = {}
+    for geom, layer in zip(streets.geometry, layers):
+        coords = np.asarray(geom.coords)[:, :2]
+        ends = []
+        for x, y in (coords[0], coords[-1]):
+            key = (int(round(x / precision)), int(round(y / precision)))
+            if key not in node_ids:
+                node_ids[key] = len(node_ids)
+                G.add_node(node_ids[key], x=x, y=y)
+            ends.append(node_ids[key])
+
+        # Loops don't lead anywhere else
+        if ends[0] != ends[1]:
+            G.add_edge(ends[0], ends[1], geometry=geom, layer=layer)
+
+    return G
+
+
+def osm_schema(st_crossings, opensidewalks=False):
+    #
+    # Schema correction stuff
+    #
+
+    st_crossings['highway'] = 'footway'
+    st_crossings['footway'] = 'crossing'
+
+    if not opensidewalks:
+        return st_crossings, None
+
+    # If the OpenSidewalks schema is desired, transform the data to OSM
+    # schema
+    st_crossings, sw_links = make_links(st_crossings, offset=1)
+    st_crossings['layer'] = st_crossings['layer'].replace(0, np.nan)
+    sw_links['layer'] = sw_links['layer'].replace(0, np.nan)
+
+    return st_crossings, sw_links
@@ -0,0 +1,156 @@
+'''Run many regions, listed in a manifest, across a pool of processes.
+
+A manifest is a CSV file with a header row, or a JSON list of objects, with
+these fields for every region:
+
+- outfile: Where to write the crossings.
+- sidewalks: A sidewalks file or prepared dataset (see the prepare
+  command), or
+- west, south, east, north: A bounding box to fetch sidewalks for.
+- opensidewalks (optional): Whether to follow the OpenSidewalks schema.
+
+Relative paths are relative to the manifest.'''
+import contextlib
+import csv
+from io import StringIO
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+BBOX_FIELDS = ['west', 'south', 'east', 'north']
+
+TRUE_VALUES = ['1', 'true', 'yes', 'y']
+
+
+def read_manifest(path):
+    '''Read the regions of a manifest.
+
+    :param path: Path to the manifest, a .csv or .json file.
+    :type path: str
+    :returns: The regions, as dicts with 'outfile', 'opensidewalks' and either
+              'sidewalks' or 'bounds' keys.
+    :rtype: list of dict
+
+    '''
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            rows = json.load(f)
+    else:
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+
+    base = os.path.dirname(os.path.abspath(path))
+
+    regions = []
+    for i, row in enumerate(rows):
+        # Blank CSV cells are missing values
+        row = {k: v for k, v in row.items() if v is not None and v != ''}
+
+        if 'outfile' not in row:
+            raise ValueError('Region {} has no outfile'.format(i + 1))
+        region = {
+            'outfile': os.path.join(base, row['outfile']),
+            'opensidewalks': str(row.get('opensidewalks',
+                                         '')).lower() in TRUE_VALUES
+        }
+
+        if 'sidewalks' in row:
+            region['sidewalks'] = os.path.join(base, row['sidewalks'])
+        elif all(field in row for field in BBOX_FIELDS):
+            region['bounds'] = [float(row[field]) for field in BBOX_FIELDS]
+        else:
+            raise ValueError('Region {} needs either sidewalks or west, '
+                             'south, east and north'.format(i + 1))
+
+        regions.append(region)
+
+    return regions
+
+
+def run_batch(regions, jobs=1, **options):
+    '''Process regions in parallel, yielding a result for each one as it
+    finishes. A region that fails doesn't stop the others.
+
+    :param regions: Regions from read_manifest.
+    :type regions: list of dict
+    :param jobs: Number of regions to process at once.
+    :type jobs: int
+    :param options: Passed on to the crossing drawing of every region.
+    :returns: Results from run_region, in order of completion.
+    :rtype: iterator of dict
+
+    '''
+    tasks = [(i, region, options) for i, region in enumerate(regions)]
+
+    if jobs <= 1:
+        for task in tasks:
+            yield _run_task(task)
+        return
+
+    # Workers are reused across regions, so they only import the pipeline
+    # once. The street cache on disk is shared by all of them.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+    pool = context.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(_run_task, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _run_task(task):
+    i, region, options = task
+    return run_region(i, region, **options)
+
+
+def run_region(i, region, **options):
+    # Draw the crossings of one region. Its progress messages are captured,
+    # so that those of regions run at the same time aren't interleaved, and
+    # returned in the summary of how it went.
+    from . import io, store
+    from .metrics import Metrics
+    from .pipeline import core
+
+    metrics = Metrics()
+    result = {
+        'region': i,
+        'outfile': region['outfile'],
+        'status': 'ok',
+        'crossings': 0,
+        'error': None,
+        'output': ''
+    }
+
+    start = time.time()
+    output = StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            if 'sidewalks' in region and store.is_prepared(
+                    region['sidewalks']):
+                sidewalks = store.open_prepared(region['sidewalks'])
+            elif 'sidewalks' in region:
+                sidewalks = io.read_sidewalks(region['sidewalks'])
+            else:
+                sidewalks = io.fetch_sidewalks(*region['bounds'])
+            core(sidewalks, region['outfile'],
+                 opensidewalks=region['opensidewalks'], metrics=metrics,
+                 **options)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    else:
+        stage = metrics.stages.get('write')
+        if stage is None:
+            result['status'] = 'empty'
+        else:
+            result['crossings'] = stage['items']
+    result['output'] = output.getvalue()
+    result['seconds'] = time.time() - start
+
+    return result
@@ -0,0 +1,320 @@
+'''Benchmarks of the crossing pipeline on synthetic city grids.
+
+A synthetic city is a grid of blocks with a sidewalk ring around every block.
+The grid can be skewed (sheared, so streets don't meet at right angles) and
+every few rows can be a divided road: two one-way carriageways with separate
+intersections on each side of a median.'''
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import time
+from tempfile import mkdtemp
+
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+from shapely.geometry import LineString
+
+from . import __version__, crossings, intersections, io
+from .metrics import Metrics
+from .opensidewalks import make_links
+
+# Any projected coordinate system will do: UTM zone 10N
+CRS = {'init': 'epsg:32610'}
+
+# Block size, distance of sidewalks from the street centerline and distance
+# of each carriageway of a divided road from its centerline, in meters
+BLOCK_SIZE = 100.0
+SIDEWALK_OFFSET = 9.0
+MEDIAN_OFFSET = 5.0
+
+FORMATS = ['.geojson', '.parquet', '.fgb']
+
+# Directory the command line application is run from, so that it's this
+# version rather than an installed one
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Commands whose cold start time is measured, by function name, and modules
+# that shouldn't be loaded just to start the command line application
+STARTUP_COMMANDS = ['from_file', 'osm_file']
+HEAVY_MODULES = ['fiona', 'geopandas', 'networkx', 'numpy', 'osmnx',
+                 'overpass', 'pandas', 'shapely']
+
+
+def synthetic_city(size, skew=0.0, divided=0, seed=0):
+    '''Generate a street grid and the sidewalks around its blocks.
+
+    :param size: Approximate number of street intersections.
+    :type size: int
+    :param skew: Shear of the grid: each row is shifted by this fraction of a
+                 block relative to the previous one.
+    :type skew: float
+    :param divided: Make every nth row of streets a divided road. 0 for none.
+    :type divided: int
+    :param seed: Seed for the random jitter of intersection positions.
+    :type seed: int
+    :returns: The projected street graph and sidewalks.
+    :rtype: tuple of (networkx.MultiDiGraph, geopandas.GeoDataFrame)
+
+    '''
+    rng = np.random.RandomState(seed)
+    n = max(2, int(math.ceil(math.sqrt(size))))
+
+    def is_divided(j):
+        return divided > 0 and j % divided == divided - 1
+
+    # Intersection positions. Divided roads have a north and south node at
+    # every intersection; other nodes use the same position for both.
+    jitter = rng.normal(0, 3, (n, n, 2))
+    positions = {}
+    for i in range(n):
+        for j in range(n):
+            x = (i + j * skew) * BLOCK_SIZE + jitter[i, j, 0]
+            y = j * BLOCK_SIZE + jitter[i, j, 1]
+            if is_divided(j):
+                positions[i, j, 'n'] = (x, y + MEDIAN_OFFSET)
+                positions[i, j, 's'] = (x, y - MEDIAN_OFFSET)
+            else:
+                positions[i, j, 'n'] = positions[i, j, 's'] = (x, y)
+
+    node_ids = {}
+    G = nx.MultiDiGraph(crs=CRS)
+    for key, (x, y) in sorted(positions.items()):
+        if key[:2] + ('n',) in node_ids and not is_divided(key[1]):
+            node_ids[key] = node_ids[key[:2] + ('n',)]
+            continue
+        node_ids[key] = len(node_ids) + 1
+        G.add_node(node_ids[key], x=x, y=y)
+
+    def add_street(a, b, oneway=False):
+        u = node_ids[a]
+        v = node_ids[b]
+        start = positions[a]
+        end = positions[b]
+        middle = ((start[0] + end[0]) / 2 + rng.normal(0, 1),
+                  (start[1] + end[1]) / 2 + rng.normal(0, 1))
+        geometry = LineString([start, middle, end])
+        G.add_edge(u, v, geometry=geometry, layer=0, oneway=oneway)
+        if not oneway:
+            G.add_edge(v, u, geometry=LineString(geometry.coords[::-1]),
+                       layer=0, oneway=oneway)
+
+    for i in range(n):
+        for j in range(n):
+            if i + 1 < n:
+                if is_divided(j):
+                    # Eastbound on the north side, westbound on the south
+                    add_street((i, j, 'n'), (i + 1, j, 'n'), oneway=True)
+                    add_street((i + 1, j, 's'), (i, j, 's'), oneway=True)
+                else:
+                    add_street((i, j, 'n'), (i + 1, j, 'n'))
+            if is_divided(j):
+                # Cross the median
+                add_street((i, j, 's'), (i, j, 'n'))
+            if j + 1 < n:
+                add_street((i, j, 'n'), (i, j + 1, 's'))
+
+    # A ring of sidewalks inside every block
+    sidewalks = []
+    for i in range(n - 1):
+        for j in range(n - 1):
+            corners = np.array([positions[i, j, 'n'],
+                                positions[i + 1, j, 'n'],
+                                positions[i + 1, j + 1, 's'],
+                                positions[i, j + 1, 's']])
+            center = corners.mean(axis=0)
+            ring = corners + (center - corners) * (SIDEWALK_OFFSET /
+                                                   (BLOCK_SIZE / 2))
+            for k in range(4):
+                sidewalks.append(LineString([ring[k], ring[(k + 1) % 4]]))
+
+    sidewalks = gpd.GeoDataFrame({'geometry': sidewalks,
+                                  'layer': [0] * len(sidewalks)})
+    sidewalks.crs = CRS
+
+    return G, sidewalks
+
+
+def run_benchmark(size, skew=0.0, divided=0, workers=1, search='exhaustive',
+                  cluster_radius=0, formats=FORMATS, seed=0):
+    '''Run every stage of the pipeline on a synthetic city.
+
+    :param size: Approximate number of street intersections.
+    :type size: int
+    :returns: Parameters, item counts, the metrics of each stage (see
+              metrics.Metrics), crossing search counters and the
+              distribution of candidates evaluated per intersection.
+    :rtype: dict
+
+    '''
+    result = {
+        'version': __version__,
+        'params': {
+            'size': size,
+            'skew': skew,
+            'divided': divided,
+            'workers': workers,
+            'search': search,
+            'cluster_radius': cluster_radius,
+            'seed': seed
+        }
+    }
+    metrics = Metrics()
+
+    with metrics.stage('generate'):
+        G, sidewalks = synthetic_city(size, skew=skew, divided=divided,
+                                      seed=seed)
+
+    with metrics.stage('group_intersections'):
+        ixns = intersections.group_intersections(G)
+
+    if cluster_radius:
+        with metrics.stage('cluster_intersections'):
+            labels = intersections.cluster_intersections(ixns,
+                                                         cluster_radius)
+            ixns = intersections.merge(ixns, labels)
+
+    with metrics.stage('make_crossings'):
+        candidate_counts = []
+        st_crossings = crossings.make_crossings(
+            ixns, sidewalks, workers=workers, search=search,
+            stats=metrics.counters, candidate_counts=candidate_counts)
+    metrics.observe('candidates_evaluated_per_intersection', candidate_counts)
+
+    if st_crossings is None:
+        st_crossings = gpd.GeoDataFrame({'geometry': [], 'layer': []})
+        st_crossings.crs = CRS
+
+    # make_crossings already removes duplicates: measure it again on its
+    # output on its own
+    with metrics.stage('dedupe'):
+        endpoints = np.array([np.asarray(geom.coords)[[0, -1], :2].ravel()
+                              for geom in st_crossings.geometry])
+        crossings.unique_crossings(endpoints.reshape(-1, 4))
+
+    with metrics.stage('make_links'):
+        trimmed, sw_links = make_links(st_crossings, offset=1)
+
+    tempdir = mkdtemp()
+    try:
+        for ext in formats:
+            name = 'write_{}'.format(ext.lstrip('.'))
+            try:
+                with metrics.stage(name):
+                    io.write_crossings(st_crossings,
+                                       os.path.join(tempdir, 'crossings' +
+                                                    ext))
+            except ImportError:
+                # Optional dependency isn't installed
+                del metrics.stages[name]
+    finally:
+        shutil.rmtree(tempdir)
+
+    stages = metrics.stages
+    result['stages'] = stages
+    result['counters'] = dict(metrics.counters)
+    result['distributions'] = metrics.distributions()
+    seconds = stages['make_crossings']['seconds']
+    result['intersections'] = len(ixns.nodes)
+    result['crossings'] = len(st_crossings)
+    result['links'] = len(sw_links)
+    result['crossings_per_second'] = (len(st_crossings) / seconds
+                                      if seconds > 0 else None)
+    result['total_seconds'] = sum(s['seconds'] for s in stages.values())
+
+    return result
+
+
+def command_name(function):
+    '''Name of a command of the command line application. Recent versions
+    of click name commands after their function with dashes (from-file) and
+    older ones with underscores (from_file).
+
+    :param function: Name of the command's function.
+    :type function: str
+    :returns: Name of the command.
+    :rtype: str
+
+    '''
+    from .__main__ import crossify
+
+    for name, command in crossify.commands.items():
+        if command.callback.__name__ == function:
+            return name
+    raise KeyError(function)
+
+
+def startup_times(commands=None, repeat=3):
+    '''Time starting the command line application in a fresh interpreter.
+
+    :param commands: Arguments of each command to time. Default: --help of
+                     the application and of STARTUP_COMMANDS.
+    :type commands: list of list of str
+    :param repeat: Number of runs of each command. The fastest is reported.
+    :type repeat: int
+    :returns: Seconds taken by each command, and the heavy modules that were
+              loaded by importing the application.
+    :rtype: dict
+
+    '''
+    if commands is None:
+        commands = [['--help']] + [[command_name(function), '--help']
+                                   for function in STARTUP_COMMANDS]
+
+    seconds = {' '.join(args): best_time(args, repeat) for args in commands}
+
+    code = ('import json, sys; import crossify.__main__; '
+            'print(json.dumps([m for m in {} if m in sys.modules]))')
+    output = subprocess.check_output([sys.executable, '-c',
+                                      code.format(HEAVY_MODULES)], cwd=ROOT)
+
+    return {
+        'seconds': seconds,
+        'heavy_modules': json.loads(output.decode())
+    }
+
+
+def local_run_time(size=100, repeat=3):
+    '''Time a complete run of the command line application on a local
+    file in a fresh interpreter, imports included: preparing (reading,
+    projecting and indexing) the sidewalks of a synthetic city. Unlike the
+    commands that draw crossings, it needs no network access.
+
+    :param size: Approximate number of street intersections.
+    :type size: int
+    :param repeat: Number of runs. The fastest is reported.
+    :type repeat: int
+    :returns: Seconds taken.
+    :rtype: float
+
+    '''
+    _, sidewalks = synthetic_city(size)
+
+    tempdir = mkdtemp()
+    try:
+        sidewalks_path = os.path.join(tempdir, 'sidewalks.geojson')
+        io.write_frame(sidewalks, sidewalks_path)
+        args = [command_name('prepare'), sidewalks_path,
+                os.path.join(tempdir, 'sidewalks.prepared')]
+        return best_time(args, repeat)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def best_time(args, repeat):
+    # Fastest of several runs of the command line application, from this
+    # directory rather than an installed version
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-m', 'crossify'] + args,
+                                  cwd=ROOT, stdout=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+    return best
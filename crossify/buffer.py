@@ -0,0 +1,194 @@
+'''Crossings collected in typed column arrays rather than a list of dicts
+and LineStrings.
+
+The arrays are allocated in fixed-size chunks as crossings are added, so
+growing the buffer never copies the crossings already in it, and at most one
+chunk is partly unused. A GeoDataFrame is only made once, at the end.'''
+from collections import namedtuple
+import math
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from . import geometry
+
+# Rows allocated at a time
+CHUNK_SIZE = 4096
+
+# A crossing from start (x, y) to end (x, y). sw_left and sw_right are the
+# positions of the sidewalks it joins in the sidewalks store, or -1 if
+# unknown (crossings reused from a previous run).
+Crossing = namedtuple('Crossing', [
+    'start',
+    'end',
+    'sw_left',
+    'sw_right',
+    'search_distance',
+    'crossing_distance',
+    'dotproduct',
+    'layer'
+])
+
+# Name, dtype and row shape of each column. coords holds the start and end
+# coordinates of every crossing, and ixn the position of its intersection.
+COLUMNS = [
+    ('coords', np.float64, (4,)),
+    ('ixn', np.intp, ()),
+    ('sw_left', np.intp, ()),
+    ('sw_right', np.intp, ()),
+    ('search_distance', np.float64, ()),
+    ('crossing_distance', np.float64, ()),
+    ('dotproduct', np.float64, ()),
+    ('layer', np.int64, ())
+]
+
+# Columns of the crossings GeoDataFrame, after the geometry
+FRAME_COLUMNS = ['sw_left', 'sw_right', 'search_distance',
+                 'crossing_distance', 'dotproduct', 'layer', 'ixn']
+
+
+def empty_columns(size):
+    return {name: np.empty((size,) + shape, dtype=dtype)
+            for name, dtype, shape in COLUMNS}
+
+
+class CrossingBuffer(object):
+    '''A growing collection of crossings. Crossings whose lines would be
+    degenerate (zero length) or invalid (non-finite coordinates) are dropped
+    as they're added.
+
+    :param chunk_size: Number of rows allocated at a time.
+    :type chunk_size: int
+
+    '''
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        # Rows used in the last chunk
+        self.filled = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, ixn, crossing):
+        '''Add a crossing.
+
+        :param ixn: Position of the crossing's intersection.
+        :type ixn: int
+        :param crossing: The crossing.
+        :type crossing: Crossing
+        :returns: Whether the crossing was added.
+        :rtype: bool
+
+        '''
+        x0, y0 = crossing.start
+        x1, y1 = crossing.end
+        row = (x0, y0, x1, y1)
+        if not all(math.isfinite(x) for x in row) or (x0, y0) == (x1, y1):
+            return False
+
+        if not self.chunks or self.filled == len(self.chunks[-1]['ixn']):
+            self.chunks.append(empty_columns(self.chunk_size))
+            self.filled = 0
+        columns = self.chunks[-1]
+        j = self.filled
+
+        columns['coords'][j] = row
+        columns['ixn'][j] = ixn
+        columns['sw_left'][j] = crossing.sw_left
+        columns['sw_right'][j] = crossing.sw_right
+        columns['search_distance'][j] = crossing.search_distance
+        columns['crossing_distance'][j] = crossing.crossing_distance
+        columns['dotproduct'][j] = crossing.dotproduct
+        columns['layer'][j] = crossing.layer
+
+        self.filled += 1
+        self.size += 1
+
+        return True
+
+    def extend(self, other):
+        # Add all of the crossings of another buffer, e.g. from a worker
+        if not len(other):
+            return
+        if self.chunks:
+            # Only the last chunk can have unused rows: drop them
+            self.chunks[-1] = {name: values[:self.filled]
+                               for name, values in self.chunks[-1].items()}
+        self.chunks.append(other.columns())
+        self.filled = len(other)
+        self.size += len(other)
+
+    def columns(self):
+        '''The columns of all crossings, as arrays. Chunks are joined into one
+        the first time this is called.
+
+        :returns: Arrays keyed by column name (see COLUMNS).
+        :rtype: dict
+
+        '''
+        if not self.chunks:
+            self.chunks = [empty_columns(0)]
+        elif (len(self.chunks) > 1 or
+              self.filled < len(self.chunks[0]['ixn'])):
+            used = self.chunks[:-1] + [{name: values[:self.filled]
+                                        for name, values
+                                        in self.chunks[-1].items()}]
+            self.chunks = [{name: np.concatenate([c[name] for c in used])
+                            for name, _, _ in COLUMNS}]
+            self.filled = self.size
+
+        return self.chunks[0]
+
+    def select(self, keep):
+        # Keep only some crossings, in the given order
+        self.chunks = [{name: values[keep]
+                        for name, values in self.columns().items()}]
+        self.filled = self.size = len(keep)
+
+    def __getstate__(self):
+        # Don't pickle unused rows
+        self.columns()
+        return self.__dict__
+
+    def to_frame(self, crs, sidewalk_ids=None, nodes=None,
+                 columns=FRAME_COLUMNS):
+        '''Make a GeoDataFrame of the crossings.
+
+        :param crs: The coordinate reference system of the crossings.
+        :type crs: dict
+        :param sidewalk_ids: Labels of the sidewalks in the sidewalks store,
+                             for the sw_left and sw_right columns.
+        :type sidewalk_ids: numpy.ndarray
+        :param nodes: Intersection nodes, for the ixn column.
+        :type nodes: numpy.ndarray
+        :param columns: Columns to include besides the geometry.
+        :type columns: list of str
+        :returns: The crossings, as LineStrings.
+        :rtype: geopandas.GeoDataFrame
+
+        '''
+        arrays = self.columns()
+        offsets = np.arange(0, 2 * self.size + 1, 2)
+        lines = geometry.lines_from_arrays(arrays['coords'].reshape(-1, 2),
+                                           offsets)
+
+        data = {'geometry': lines}
+        for name in columns:
+            values = arrays[name]
+            if name in ('sw_left', 'sw_right'):
+                known = values >= 0
+                values = sidewalk_ids[np.maximum(values, 0)]
+                if not known.all():
+                    # Unknown sidewalks are missing values
+                    values = pd.Series(values).where(known).values
+            elif name == 'ixn':
+                values = nodes[values]
+            data[name] = values
+
+        gdf = gpd.GeoDataFrame(data, columns=['geometry'] + list(columns))
+        gdf.crs = crs
+
+        return gdf
@@ -0,0 +1,148 @@
+'''On-disk cache of preprocessed street data, so that repeated runs over the
+same area can skip fetching, projecting and grouping the street network.
+
+Entries are content-addressed: the key is a hash of everything the street
+data depends on (the bounding box, the OSM tags kept by osmnx and the
+crossify version). Each entry is a single .npz file. When the cache grows past
+its size cap, the least recently used entries are removed.'''
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from tempfile import mkstemp
+
+import numpy as np
+
+from . import __version__, intersections, projection
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), '../cache/streets')
+
+# Default size cap, in megabytes
+MAX_SIZE = 1024
+
+
+def cache_key(bounds, tags):
+    '''Key for the street data of an area.
+
+    :param bounds: The (west, south, east, north) lon-lat bounding box the
+                   street network is fetched for.
+    :type bounds: list of float
+    :param tags: The OSM way tags kept in the street network.
+    :type tags: list of str
+    :returns: Hex digest.
+    :rtype: str
+
+    '''
+    data = {
+        'bounds': [round(float(x), 7) for x in bounds],
+        'tags': sorted(tags),
+        'version': __version__
+    }
+    dumped = json.dumps(data, sort_keys=True)
+    return hashlib.sha1(dumped.encode()).hexdigest()
+
+
+def load_streets(key, crs, cache_dir=CACHE_DIR):
+    '''Load cached street data.
+
+    :param key: Key from cache_key.
+    :type key: str
+    :param crs: The coordinate reference system the data must be in. Entries
+                in a different one are ignored.
+    :type crs: dict
+    :returns: The intersections and the lon-lat coordinates of their nodes, or
+              None if there's no usable entry.
+    :rtype: tuple of (intersections.Intersections, numpy.ndarray,
+            numpy.ndarray)
+
+    '''
+    entry = entry_path(key, cache_dir)
+
+    # Other processes may share the cache and evict the entry at any time
+    try:
+        with np.load(entry) as data:
+            if str(data['crs']) != projection.crs_name(crs):
+                return None
+            ixns = intersections.Intersections(
+                **{field: data[field]
+                   for field in intersections.Intersections._fields})
+            lon = data['lon']
+            lat = data['lat']
+
+        # Mark the entry as recently used
+        os.utime(entry, None)
+    except (IOError, OSError):
+        return None
+
+    return ixns, lon, lat
+
+
+def save_streets(key, crs, ixns, lon, lat, cache_dir=CACHE_DIR,
+                 max_size=MAX_SIZE):
+    '''Store street data in the cache, then evict old entries if the cache is
+    larger than max_size megabytes.'''
+    with atomic_file(entry_path(key, cache_dir), 'wb') as f:
+        np.savez(f, crs=projection.crs_name(crs), lon=lon, lat=lat,
+                 **ixns._asdict())
+
+    evict(cache_dir, max_size)
+
+
+@contextmanager
+def atomic_file(path, mode='w'):
+    '''Open a cache entry for writing. The entry is written to a temporary
+    file in the same directory, which replaces path once it's complete, so
+    processes sharing the cache never see a partial entry.
+
+    :param path: Path of the entry. Its directory is created if needed.
+    :type path: str
+    :param mode: Mode the temporary file is opened with ('w' or 'wb').
+    :type mode: str
+    :returns: The open temporary file.
+    :rtype: file
+
+    '''
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+
+    fd, tempfile = mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tempfile, path)
+    except BaseException:
+        os.remove(tempfile)
+        raise
+
+
+def evict(cache_dir, max_size):
+    # Remove the least recently used entries until the cache fits. Entries
+    # may disappear as we go if other processes share the cache.
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size * 1024 ** 2:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+
+def entry_path(key, cache_dir):
+    return os.path.join(cache_dir, '{}.npz'.format(key))
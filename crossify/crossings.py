@@ -1,57 +1,189 @@
-import geopandas as gpd
+from collections import Counter
+import multiprocessing
+import warnings
+
 import numpy as np
 from shapely.geometry import LineString, Point, Polygon
+from shapely.prepared import prep
+
+from . import geometry, incremental, intersections, store
+from .buffer import Crossing, CrossingBuffer
+
+
+START_DIST = 4
+INCREMENT = 2
+MAX_DIST_ALONG = 25
+MAX_CROSSING_DIST = 30
+OFFSET = MAX_CROSSING_DIST / 2
 
-from . import validators
+SEARCH_MODES = ['exhaustive', 'bounded', 'compare']
 
+# Crossings whose endpoints round to the same grid cell are duplicates
+DEDUPE_PRECISION = 1e-2
 
-def make_crossings(intersections_dict, sidewalks):
+# Inputs shared with worker processes. They're set before the pool starts so
+# that forked workers inherit them instead of receiving a pickled copy with
+# every task.
+_worker_state = {}
+
+
+def make_crossings(ixns, sidewalks, workers=1, search='exhaustive',
+                   state=None, dedupe_tolerance=None, stats=None,
+                   candidate_counts=None, as_frame=True):
+    # Crossings are collected in a CrossingBuffer. With as_frame=False, it's
+    # returned as it is (possibly empty) instead of as a GeoDataFrame. If
+    # candidate_counts is a list, the number of candidates evaluated for
+    # every intersection drawn is appended to it.
+    if not isinstance(sidewalks, store.Sidewalks):
+        sidewalks = store.from_frame(sidewalks)
     crs = sidewalks.crs
 
-    validators.standardize_layer(sidewalks)
-
-    ixn_dat = []
-    st_crossings = []
-
-    # TODO: vectorize these operations for performance improvement?
-    for i, (ixn, data) in enumerate(intersections_dict.items()):
-        ixn_dat.append({
-            'geometry': data['geometry'],
-            'ixn': i
-        })
-        for street in data['streets']:
-            # Protect against invalid inputs
-            street['layer'] = validators.transform_layer(street['layer'])
-            new_crossing = make_crossing(street, sidewalks, data['streets'])
-            if new_crossing is not None:
-                st_crossings.append(new_crossing)
-
-    if not st_crossings:
+    todo = np.arange(len(ixns.nodes))
+
+    if state is not None:
+        # Incremental run: hash the inputs of every intersection, which is
+        # cheap, and only draw the crossings of those that changed since the
+        # previous run
+        sidewalk_keys = {}
+        hashes = {ixns.nodes[i]: incremental.group_hash(ixns, i, sidewalks,
+                                                        OFFSET, sidewalk_keys)
+                  for i in todo}
+        reused = incremental.reuse_crossings(state, hashes)
+        todo = np.array([i for i in todo if ixns.nodes[i] not in reused],
+                        dtype=np.intp)
+        edges = ixns.street_edge[np.concatenate(
+            [intersections.streets(ixns, i) for i in todo] +
+            [np.empty(0, dtype=np.intp)])]
+    else:
+        reused = {}
+        edges = None
+
+    corridors = build_corridors(ixns, sidewalks, edges=edges)
+
+    if workers > 1 and len(todo) > 1:
+        st_crossings = make_crossings_parallel(ixns, todo, sidewalks,
+                                               corridors, workers, search,
+                                               stats, candidate_counts)
+    else:
+        st_crossings = crossings_for_intersections(ixns, todo, sidewalks,
+                                                   corridors, search, stats,
+                                                   candidate_counts)
+
+    if state is not None:
+        incremental.update_state(state, hashes, reused, st_crossings,
+                                 ixns.nodes)
+        for i, node in enumerate(ixns.nodes):
+            for record in reused.get(node, []):
+                coords = record['coords']
+                st_crossings.append(i, Crossing(
+                    coords[0], coords[-1], -1, -1, np.nan, np.nan, np.nan,
+                    record['layer']))
+
+    # Remove duplicates
+    keep = unique_crossings(st_crossings.columns()['coords'],
+                            tolerance=dedupe_tolerance)
+    if stats is not None:
+        stats['duplicates'] += len(st_crossings) - len(keep)
+    st_crossings.select(keep)
+
+    if not as_frame:
+        return st_crossings
+    if not len(st_crossings):
         return None
 
-    st_crossings = gpd.GeoDataFrame(st_crossings)
-    st_crossings = st_crossings[st_crossings.type == 'LineString']
-    st_crossings = st_crossings[st_crossings.is_valid]
+    return st_crossings.to_frame(crs, sidewalks.ids, ixns.nodes)
+
+
+def crossings_for_intersections(ixns, todo, sidewalks, corridors=None,
+                                search='exhaustive', stats=None,
+                                candidate_counts=None):
+    st_crossings = CrossingBuffer()
+    if stats is None:
+        stats = Counter()
+
+    for i in todo:
+        # Shared by all of the intersection's streets
+        index = street_index(ixns, i)
+        stats['intersections'] += 1
+        stats['street_segments_indexed'] += len(index[0])
+        evaluated = stats['candidates_evaluated']
+        for s in intersections.streets(ixns, i):
+            new_crossing = make_crossing(ixns, s, sidewalks, corridors,
+                                         search, index, stats)
+            if (new_crossing is not None and
+                    not st_crossings.append(i, new_crossing)):
+                stats['rejected_invalid'] += 1
+        if candidate_counts is not None:
+            candidate_counts.append(stats['candidates_evaluated'] -
+                                    evaluated)
 
-    # Remove duplicates
-    def comp(geom):
-        p1 = np.round(geom.coords[0], 2)
-        p2 = np.round(geom.coords[-1], 2)
-        return str([p1, p2])
+    return st_crossings
 
-    comparison = st_crossings.geometry.apply(comp)
-    comparison.name = 'comp'
-    unique = st_crossings.groupby(comparison).first()
-    st_crossings = gpd.GeoDataFrame(unique.reset_index())
-    st_crossings.crs = crs
+
+def make_crossings_parallel(ixns, todo, sidewalks, corridors, workers,
+                            search='exhaustive', stats=None,
+                            candidate_counts=None):
+    # Several chunks per worker to even out the load, as intersections vary a
+    # lot in complexity
+    chunksize = max(1, int(np.ceil(len(todo) / (4 * workers))))
+    chunks = [todo[start:start + chunksize]
+              for start in range(0, len(todo), chunksize)]
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        _init_worker(ixns, sidewalks, corridors, search)
+        pool = context.Pool(workers)
+    else:
+        # Each worker receives one copy of the inputs when it starts
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(workers, initializer=_init_worker,
+                            initargs=(ixns, sidewalks, corridors, search))
+
+    try:
+        # imap returns results in chunk order, so the output is the same as a
+        # serial run
+        st_crossings = CrossingBuffer()
+        for chunk_crossings, chunk_stats, chunk_counts in pool.imap(
+                _crossings_for_chunk, chunks):
+            st_crossings.extend(chunk_crossings)
+            if stats is not None:
+                stats.update(chunk_stats)
+            if candidate_counts is not None:
+                candidate_counts.extend(chunk_counts)
+    finally:
+        pool.close()
+        pool.join()
+        _worker_state.clear()
 
     return st_crossings
 
 
-def make_crossing(street, sidewalks, streets_list):
+def _init_worker(ixns, sidewalks, corridors, search):
+    _worker_state['ixns'] = ixns
+    _worker_state['sidewalks'] = sidewalks
+    _worker_state['corridors'] = corridors
+    _worker_state['search'] = search
+
+
+def _crossings_for_chunk(chunk):
+    # Counters and candidate counts are returned with the crossings and
+    # merged by the parent
+    stats = Counter()
+    candidate_counts = []
+    chunk_crossings = crossings_for_intersections(_worker_state['ixns'],
+                                                  chunk,
+                                                  _worker_state['sidewalks'],
+                                                  _worker_state['corridors'],
+                                                  _worker_state['search'],
+                                                  stats, candidate_counts)
+    return chunk_crossings, stats, candidate_counts
+
+
+def make_crossing(ixns, s, sidewalks, corridors=None, search='exhaustive',
+                  index=None, stats=None):
     '''Attempts to create a street crossing line given a street segment and
-    a GeoDataFrame sidewalks dataset. The street and sidewalks should have
-    these properties:
+    a sidewalks dataset. The street and sidewalks should have these
+    properties:
 
     (1) The street should start at the street intersection and extend away
     from it.
@@ -60,19 +192,35 @@ def make_crossing(street, sidewalks, streets_list):
     If a crossing cannot be created that meets certain internal parameters,
     None is returned.
 
-    :param street: The street geometry.
-    :type street: shapely.geometry.LineString
+    :param ixns: The intersections and their streets.
+    :type ixns: intersections.Intersections
+    :param s: Index of the street in ixns.
+    :type s: int
     :param sidewalks: The sidewalks dataset.
-    :type sidewalks: geopandas.GeoDataFrame
-    :returns: If a crossing can be made, a shapely Linestring. Otherwise, None.
-    :rtype: shapely.geometry.LineString or None
+    :type sidewalks: store.Sidewalks
+    :param corridors: Precomputed candidate sidewalks for each street edge, as
+                      returned by build_corridors.
+    :type corridors: list
+    :param search: How to search the candidate crossings. 'exhaustive'
+                   evaluates every candidate, 'bounded' stops as soon as no
+                   remaining candidate can have a lower cost and 'compare'
+                   runs both, warning when they disagree.
+    :type search: str
+    :param index: The segments of the intersection's streets, as returned by
+                  street_index.
+    :type index: tuple of numpy.ndarray
+    :param stats: Counters of candidates evaluated and the reasons they were
+                  rejected, updated in place.
+    :type stats: collections.Counter
+    :returns: If a crossing can be made, the crossing. Otherwise, None.
+    :rtype: buffer.Crossing or None
 
     '''
     # 'Walk' along the street in 1-meter increments, finding the closest
     # sidewalk + the distance along each end. Reject those with inappropriate
     # angles and differences in length.
-    # TODO: this is a good place for optimizations, it's a search problem.
-    # Can probably do something like binary search.
+    # The 'bounded' search mode treats this as a search problem: see
+    # search_bounded.
 
     # Clip street in half: don't want to cross too far in.
     # TODO: this should be done in a more sophisticated way. e.g. dead ends
@@ -83,162 +231,481 @@ def make_crossing(street, sidewalks, streets_list):
     # this to limit the sidewalks to be considered at each point. Fewer
     # distance and side-of-line queries!
 
-    START_DIST = 4
-    INCREMENT = 2
-    MAX_DIST_ALONG = 25
-    MAX_CROSSING_DIST = 30
-    OFFSET = MAX_CROSSING_DIST / 2
+    if stats is None:
+        stats = Counter()
+    stats['streets'] += 1
+
+    st_coords = intersections.street_coords(ixns, s)
+    st_cumulative = geometry.cumulative_lengths(st_coords)
 
-    st_distance = min(street['geometry'].length / 2, MAX_DIST_ALONG)
+    st_distance = min(st_cumulative[-1] / 2, MAX_DIST_ALONG)
     start_dist = min(START_DIST, st_distance / 2)
-    layer = street['layer']
+    layer = ixns.street_layer[s]
 
     # Create buffer for the street search area, one for each side, then find
     # the sidewalks intersecting that buffer - use as candidates for
     # right/left
-    sw_left = get_side_sidewalks(OFFSET, 'left', street, sidewalks)
-    sw_right = get_side_sidewalks(OFFSET, 'right', street, sidewalks)
-
-    if sw_left.empty or sw_right.empty:
+    if corridors is not None:
+        left_idx, right_idx = street_corridors(ixns, s, corridors)
+    else:
+        st_geom = LineString(st_coords)
+        left_idx = get_side_sidewalks(OFFSET, 'left', st_geom, sidewalks)
+        right_idx = get_side_sidewalks(OFFSET, 'right', st_geom, sidewalks)
+    stats['sidewalk_queries'] += 2
+    stats['sidewalks_queried'] += len(left_idx) + len(right_idx)
+
+    if not len(left_idx) or not len(right_idx):
         # One of the sides has no sidewalks to connect to! Abort!
+        stats['rejected_street_no_sidewalks'] += 1
         return None
 
     # Restrict to sidewalks on the same 'layer' as the input
-    sw_left = sw_left[sw_left['layer'] == layer]
-    sw_right = sw_right[sw_right['layer'] == layer]
+    left_idx = left_idx[sidewalks.layer[left_idx] == layer]
+    right_idx = right_idx[sidewalks.layer[right_idx] == layer]
 
-    if sw_left.empty or sw_right.empty:
+    if not len(left_idx) or not len(right_idx):
         # One of the sides has no sidewalks to connect to! Abort!
+        stats['rejected_street_layer'] += 1
+        return None
+
+    # Grab every sample point along the outgoing street at once
+    dists = np.arange(start_dist, st_distance, INCREMENT)
+    if not dists.size:
+        stats['rejected_street_too_short'] += 1
         return None
+    points = geometry.interpolate(st_coords, dists, st_cumulative)
+
+    left_segments = sidewalk_segments(sidewalks, left_idx)
+    right_segments = sidewalk_segments(sidewalks, right_idx)
+
+    start1, end1, left1, right1 = crossings_from_points(points,
+                                                        left_segments,
+                                                        right_segments)
+    start2, end2, left2, right2 = crossings_from_points(points,
+                                                        right_segments,
+                                                        left_segments)
+
+    # Interleave the two crossing directions so that candidates keep their
+    # order along the street
+    n = 2 * dists.size
+    starts = np.empty((n, 2))
+    starts[0::2] = start1
+    starts[1::2] = start2
+    ends = np.empty((n, 2))
+    ends[0::2] = end1
+    ends[1::2] = end2
+    idx_left = np.empty(n, dtype=np.intp)
+    idx_left[0::2] = left_idx[left1]
+    idx_left[1::2] = right_idx[left2]
+    idx_right = np.empty(n, dtype=np.intp)
+    idx_right[0::2] = right_idx[right1]
+    idx_right[1::2] = left_idx[right2]
+    search_distances = np.repeat(dists, 2)
+
+    #
+    # Filters
+    #
+    lengths = np.hypot(*(ends - starts).T)
+
+    # Cheap filter first: can't be too long
+    valid = (lengths > 0) & (lengths <= MAX_CROSSING_DIST)
+    stats['candidates'] += n
+    stats['rejected_too_long'] += int(n - np.count_nonzero(valid))
+
+    # Orthogonality to the street segment at each sample distance
+    dotproducts = np.full(n, np.nan)
+    if valid.any():
+        seg_idx = np.searchsorted(st_cumulative, search_distances[valid])
+        seg_idx = np.clip(seg_idx, 1, len(st_coords) - 1)
+        st_vectors = st_coords[seg_idx] - st_coords[seg_idx - 1]
+        st_vectors /= np.hypot(*st_vectors.T)[:, np.newaxis]
+        cr_vectors = (ends - starts)[valid] / lengths[valid, np.newaxis]
+        dotproducts[valid] = (cr_vectors * st_vectors).sum(axis=1)
 
-    crossings = []
-    for dist in np.arange(start_dist, st_distance, INCREMENT):
-        # Grab a point along the outgoing street
-        st_geom = street['geometry']
-        point = st_geom.interpolate(dist)
-
-        crossing1, left1, right1 = crossing_from_point(point, sw_left,
-                                                       sw_right)
-        crossing2, left2, right2 = crossing_from_point(point, sw_right,
-                                                       sw_left)
-
-        crossings.append({
-            'geometry': crossing1,
-            'sw_left': left1,
-            'sw_right': right1
-        })
-        crossings.append({
-            'geometry': crossing2,
-            'sw_left': left2,
-            'sw_right': right2
-        })
-
-    candidates = []
-    for crossing in crossings:
-        geometry_cr = crossing['geometry']
-        geometry_st = street['geometry']
-        #
-        # Filters
-        #
-        if not geometry_cr.intersects(geometry_st):
+    # Return the shortest crossing.
+    # TODO: Should also bias towards *earlier* appearances, i.e. towards
+    # corner.
+    # The cost is base_costs + 2e-1 * crossing_distance. The crossing
+    # distance is only known once the (more expensive) street intersection
+    # has been found.
+    base_costs = lengths + 5e2 * np.abs(dotproducts)
+
+    # Crossings can't cross any other street on the same layer
+    if index is None:
+        i = np.searchsorted(ixns.offsets, s, side='right') - 1
+        index = street_index(ixns, i)
+    seg_starts, seg_ends, seg_street = index
+    others = (seg_street != s) & (ixns.street_layer[seg_street] == layer)
+    other_segments = (seg_starts[others], seg_ends[others])
+
+    args = (starts, ends, base_costs, valid, st_coords, st_cumulative,
+            other_segments)
+    if search == 'exhaustive':
+        result = search_exhaustive(*args, stats=stats)
+    elif search == 'bounded':
+        result = search_bounded(*args, stats=stats)
+    elif search == 'compare':
+        result = search_exhaustive(*args, stats=stats)
+        bounded = search_bounded(*args)
+        if result != bounded:
+            edge = tuple(ixns.edges[ixns.street_edge[s]])
+            warnings.warn('Bounded search chose candidate {} instead of {} '
+                          'for street {}'.format(bounded, result, edge))
+    else:
+        raise ValueError('Unknown search mode: {}'.format(search))
+
+    if result is None:
+        stats['rejected_street_no_candidate'] += 1
+        return None
+    i, crossing_distance = result
+    stats['crossings'] += 1
+
+    return Crossing(starts[i], ends[i], idx_left[i], idx_right[i],
+                    search_distances[i], crossing_distance, dotproducts[i],
+                    layer)
+
+
+def search_exhaustive(starts, ends, base_costs, valid, st_coords,
+                      st_cumulative, other_segments, stats=None):
+    # Apply every filter to all candidates at once, then pick the cheapest.
+    # Returns the (index, crossing distance) of the best candidate, or None.
+    if stats is None:
+        stats = Counter()
+    stats['candidates_evaluated'] += int(np.count_nonzero(valid))
+
+    crossing_distances = street_crossing_distances(starts, ends, st_coords,
+                                                   st_cumulative)
+    # Must cross the street exactly once
+    crosses = valid & ~np.isnan(crossing_distances)
+    stats['rejected_misses_street'] += int(np.count_nonzero(valid) -
+                                           np.count_nonzero(crosses))
+    candidates = np.flatnonzero(crosses)
+    # Must not cross other streets
+    blocked = crosses_other_streets(starts[candidates], ends[candidates],
+                                    other_segments)
+    stats['rejected_crosses_other_street'] += int(
+        np.count_nonzero(blocked))
+    candidates = candidates[~blocked]
+    if not candidates.size:
+        return None
+
+    costs = base_costs[candidates] + 2e-1 * crossing_distances[candidates]
+    # argmin returns the first of any ties, i.e. the earliest candidate
+    i = candidates[np.argmin(costs)]
+
+    return i, crossing_distances[i]
+
+
+def search_bounded(starts, ends, base_costs, valid, st_coords, st_cumulative,
+                   other_segments, stats=None):
+    # Visit candidates in order of a lower bound on their cost and stop once
+    # no remaining candidate can beat the best one found so far. The crossing
+    # distance along the street can't be shorter than the straight-line
+    # distance from the start of the street to the crossing, which gives the
+    # bound. Returns the same candidate as search_exhaustive, including ties
+    # (broken by candidate order).
+    if stats is None:
+        stats = Counter()
+    candidates = np.flatnonzero(valid)
+    if not candidates.size:
+        return None
+
+    _, dist2 = geometry.closest_points(st_coords[:1], starts[candidates],
+                                       ends[candidates])
+    bounds = base_costs[candidates] + 2e-1 * np.sqrt(dist2[0])
+    order = np.argsort(bounds, kind='stable')
+
+    best = None
+    best_cost = np.inf
+    for visited, (i, bound) in enumerate(zip(candidates[order],
+                                             bounds[order])):
+        if bound > best_cost:
+            stats['pruned'] += len(candidates) - visited
+            break
+        stats['candidates_evaluated'] += 1
+
+        crossing_distance = street_crossing_distances(
+            starts[i:i + 1], ends[i:i + 1], st_coords, st_cumulative)[0]
+        if np.isnan(crossing_distance):
+            stats['rejected_misses_street'] += 1
             continue
 
-        if geometry_cr.length > MAX_CROSSING_DIST:
+        cost = base_costs[i] + 2e-1 * crossing_distance
+        if cost > best_cost or (cost == best_cost and i > best[0]):
+            stats['rejected_higher_cost'] += 1
             continue
 
-        other_streets = []
-        for st in streets_list:
-            if st == street:
-                continue
-            if st['layer'] != layer:
-                continue
-            other_streets.append(st['geometry'])
+        if crosses_other_streets(starts[i:i + 1], ends[i:i + 1],
+                                 other_segments)[0]:
+            stats['rejected_crosses_other_street'] += 1
+            continue
 
-        if other_streets:
-            if crosses_other_streets(geometry_cr, other_streets):
-                continue
+        best = (i, crossing_distance)
+        best_cost = cost
 
-        # The sides have passed the filter! Add their data to the list
-        ixn = geometry_st.intersection(geometry_cr)
-        if ixn.type != 'Point':
-            continue
+    return best
 
-        crossing_distance = geometry_st.project(ixn)
-        crossing['search_distance'] = dist
-        crossing['crossing_distance'] = crossing_distance
-        st_seg = segment_at_distance(geometry_st, dist)
-        crossing['dotproduct'] = dotproduct(geometry_cr, st_seg)
-        crossing['layer'] = layer
 
-        candidates.append(crossing)
+def build_corridors(ixns, sidewalks, offset=OFFSET, edges=None):
+    '''Find the candidate sidewalks on each side of every street edge. Streets
+    are shared by the intersections at either end, so this is done once per
+    edge rather than once per intersection.
 
-    if not candidates:
-        return None
+    :param ixns: The intersections and their streets.
+    :type ixns: intersections.Intersections
+    :param sidewalks: The sidewalks dataset.
+    :type sidewalks: store.Sidewalks
+    :param offset: Width of the search corridor on each side of the street.
+    :type offset: float
+    :param edges: Only find the candidates of these edges, e.g. those of the
+                  intersections redrawn by an incremental run. Default: all.
+    :type edges: numpy.ndarray of int
+    :returns: Positions of the left and right candidate sidewalks, indexed by
+              edge, or None for edges that weren't requested. Left and right
+              are relative to the edge's canonical direction (see
+              intersections.Intersections).
+    :rtype: list of (numpy.ndarray, numpy.ndarray)
 
-    # Return the shortest crossing.
-    # TODO: Should also bias towards *earlier* appearances, i.e. towards
-    # corner.
-    # lengths = np.array([line['crossing'].length for line in lines])
-    # # Inverse distance function (distance from intersection)
-    # distance_metric = 1 / np.array([line['distance'] for line in lines])
+    '''
+    corridors = [None] * len(ixns.edges)
+    _, first = np.unique(ixns.street_edge, return_index=True)
+    if edges is not None:
+        wanted = np.zeros(len(ixns.edges), dtype=bool)
+        wanted[edges] = True
+        first = first[wanted[ixns.street_edge[first]]]
+    for s in first:
+        st_geom = intersections.street_geometry(ixns, s)
+        left = get_side_sidewalks(offset, 'left', st_geom, sidewalks)
+        right = get_side_sidewalks(offset, 'right', st_geom, sidewalks)
 
-    # lengths * distance_metric
-    def cost(candidate):
-        terms = []
-        terms.append(candidate['geometry'].length)
-        terms.append(2e-1 * candidate['crossing_distance'])
-        terms.append(5e2 * abs(candidate['dotproduct']))
-        return sum(terms)
+        if ixns.street_forward[s]:
+            corridors[ixns.street_edge[s]] = (left, right)
+        else:
+            corridors[ixns.street_edge[s]] = (right, left)
 
-    best = sorted(candidates, key=cost)[0]
+    return corridors
 
-    return best
+
+def street_corridors(ixns, s, corridors):
+    # Left and right candidate sidewalk positions in the street's direction
+    left, right = corridors[ixns.street_edge[s]]
+    if ixns.street_forward[s]:
+        return left, right
+    return right, left
 
 
 def get_side_sidewalks(offset, side, street, sidewalks):
-    # TODO: do this once for the whole street
-    offset = street['geometry'].parallel_offset(offset, side, 0, 1, 1)
-    if offset.type == 'MultiLineString':
+    # Positions of the sidewalks within offset of one side of a street
+    # geometry
+    offset = street.parallel_offset(offset, side, 0, 1, 1)
+    if offset.geom_type == 'MultiLineString':
         # Convert to LineString
-        coords = []
+        offset_coords = []
         for geom in offset.geoms:
-            coords += list(geom.coords)
-        offset = LineString(coords)
-    if side == 'left':
-        offset.coords = offset.coords[::-1]
-    st_buffer = Polygon(list(street['geometry'].coords) +
-                        list(offset.coords) +
-                        [street['geometry'].coords[0]])
-    query = sidewalks.sindex.intersection(st_buffer.bounds, objects=True)
-    query_sidewalks = sidewalks.loc[[q.object for q in query]]
-    side_sidewalks = query_sidewalks[query_sidewalks.intersects(st_buffer)]
+            offset_coords += list(geom.coords)
+    else:
+        offset_coords = list(offset.coords)
+
+    # The ring goes out along the street and back along the offset. Older
+    # versions of GEOS reverse right-hand offsets and newer ones don't, so
+    # check which end of the offset is next to the end of the street.
+    street_coords = list(street.coords)
+    if offset_coords:
+        start = np.asarray(offset_coords[0]) - street_coords[0]
+        end = np.asarray(offset_coords[-1]) - street_coords[0]
+        if np.hypot(*start[:2]) < np.hypot(*end[:2]):
+            offset_coords = offset_coords[::-1]
+    st_buffer = Polygon(street_coords + offset_coords + [street_coords[0]])
+    candidates = store.query(sidewalks, st_buffer.bounds)
+    st_buffer = prep(st_buffer)
+    side_sidewalks = [i for i in candidates
+                      if st_buffer.intersects(store.line(sidewalks, i))]
+
+    return np.array(side_sidewalks, dtype=np.int32)
+
+
+def sidewalk_segments(sidewalks, positions):
+    # Segments of some of the sidewalks, owners index into positions
+    coords, offsets = store.lines(sidewalks, positions)
+    return geometry.line_segments(coords, offsets)
+
+
+def crossings_from_points(points, segments1, segments2):
+    # Find the closest point on each sidewalk (left and right) to the points.
+    # For each of these points, find the closest sidewalk to it on the other
+    # side, then draw a line to the point on that sidewalk closest to the
+    # original point.
+    starts1, ends1, owner1 = segments1
+    starts2, ends2, owner2 = segments2
+    rows = np.arange(len(points))
+
+    closest, dist2 = geometry.closest_points(points, starts1, ends1)
+    nearest = dist2.argmin(axis=1)
+    point1 = closest[rows, nearest]
+    idx1 = owner1[nearest]
+
+    _, dist2 = geometry.closest_points(point1, starts2, ends2)
+    idx2 = owner2[dist2.argmin(axis=1)]
+
+    closest, dist2 = geometry.closest_points(points, starts2, ends2)
+    dist2[owner2[np.newaxis, :] != idx2[:, np.newaxis]] = np.inf
+    point2 = closest[rows, dist2.argmin(axis=1)]
+
+    return point1, point2, idx1, idx2
+
+
+def street_crossing_distances(starts, ends, st_coords, st_cumulative):
+    # Distance along the street at which each crossing intersects it. nan if
+    # the crossing misses the street or the intersection isn't a single
+    # point.
+    st_starts = st_coords[np.newaxis, :-1]
+    st_ends = st_coords[np.newaxis, 1:]
+    p1 = starts[:, np.newaxis]
+    p2 = ends[:, np.newaxis]
+
+    hits = geometry.segments_intersect(p1, p2, st_starts, st_ends)
+    params = geometry.intersection_params(p1, p2, st_starts, st_ends)
+    # Overlapping collinear segments don't intersect at a point
+    overlapping = (hits & np.isnan(params)).any(axis=1)
+
+    seg_lengths = np.diff(st_cumulative)
+    along = st_cumulative[:-1] + np.clip(params, 0, 1) * seg_lengths
+    first = np.where(hits, along, np.inf).min(axis=1)
+    last = np.where(hits, along, -np.inf).max(axis=1)
+
+    # Hitting the street at a shared vertex counts as a single point
+    is_point = hits.any(axis=1) & ~overlapping & (last - first < 1e-6)
+
+    return np.where(is_point, first, np.nan)
+
+
+def street_index(ixns, i):
+    '''Gather the segments of an intersection's streets, which its crossings
+    must not cross, once for all of its streets. The streets of a cluster of
+    intersections (see intersections.merge) start at several nodes.
+    crosses_other_streets only tests the segments whose bounding boxes
+    overlap a crossing, so segments far from the intersection are cheap.
+
+    :param ixns: The intersections and their streets.
+    :type ixns: intersections.Intersections
+    :param i: Index of the intersection.
+    :type i: int
+    :returns: Segment start points, end points and the index of the street
+              each segment belongs to.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    # The intersection's streets are contiguous in the street table
+    first, last = ixns.offsets[i], ixns.offsets[i + 1]
+    streets = np.arange(first, last)
+    offsets = ixns.street_offsets[first:last + 1]
+    coords = ixns.street_coords[offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
 
-    return side_sidewalks
+    seg_starts, seg_ends, owner = geometry.line_segments(coords, offsets)
 
+    return seg_starts, seg_ends, streets[owner]
 
-def crossing_from_point(point, sidewalks1, sidewalks2):
-    # Find the closest point on each sidewalk (left and right) to the point.
-    # For each of these points, find the closest point to it on the other
-    # sidewalk, then draw a line.
 
-    idx1 = sidewalks1.distance(point).sort_values().index[0]
-    geometry1 = sidewalks1.loc[idx1, 'geometry']
-    point1 = geometry1.interpolate(geometry1.project(point))
+def crosses_other_streets(starts, ends, other_segments):
+    # Test a batch of crossing lines against the segments of other streets
+    seg_starts, seg_ends = other_segments
+    if not seg_starts.size or not starts.size:
+        return np.zeros(len(starts), dtype=bool)
 
-    idx2 = sidewalks2.distance(point1).sort_values().index[0]
-    geometry2 = sidewalks2.loc[idx2, 'geometry']
-    point2 = geometry2.interpolate(geometry2.project(point))
+    # Cheap bounding box test first, then the exact test on the pairs left
+    cr_min = np.minimum(starts, ends)
+    cr_max = np.maximum(starts, ends)
+    seg_min = np.minimum(seg_starts, seg_ends)
+    seg_max = np.maximum(seg_starts, seg_ends)
+    overlap = ((cr_min[:, np.newaxis] <= seg_max[np.newaxis]) &
+               (seg_min[np.newaxis] <= cr_max[:, np.newaxis])).all(axis=2)
 
-    crossing = LineString([point1, point2])
+    rows, cols = np.nonzero(overlap)
+    hits = geometry.segments_intersect(starts[rows], ends[rows],
+                                       seg_starts[cols], seg_ends[cols])
 
-    return crossing, idx1, idx2
+    crosses = np.zeros(len(starts), dtype=bool)
+    crosses[rows[hits]] = True
 
+    return crosses
 
-def crosses_other_streets(crossing, other_streets):
-    for street in other_streets:
-        if street.intersects(crossing):
-            return True
-    return False
+
+def unique_crossings(endpoints, precision=DEDUPE_PRECISION, tolerance=None):
+    '''Find the unique crossings, regardless of their direction.
+
+    Endpoints are snapped to an integer grid and put in a canonical order, so
+    that exact duplicates can be found with a sort. Optionally, crossings
+    whose endpoints are all within a tolerance of an earlier crossing are
+    also dropped.
+
+    :param endpoints: (N, 4) array of crossing start (x, y) and end (x, y)
+                      coordinates.
+    :type endpoints: numpy.ndarray
+    :param precision: Size of the grid cells endpoints are snapped to.
+    :type precision: float
+    :param tolerance: If set, the distance within which crossing endpoints are
+                      considered the same.
+    :type tolerance: float
+    :returns: Positions of the crossings to keep, in their original order.
+    :rtype: numpy.ndarray
+
+    '''
+    if not len(endpoints):
+        return np.empty(0, dtype=np.intp)
+
+    grid = np.round(endpoints / precision).astype(np.int64)
+    start = grid[:, :2]
+    end = grid[:, 2:]
+    swap = ((start[:, 0] > end[:, 0]) |
+            ((start[:, 0] == end[:, 0]) & (start[:, 1] > end[:, 1])))
+    canonical = np.where(swap[:, np.newaxis], np.hstack([end, start]), grid)
+
+    # Sort the rows (lexsort is stable, so equal rows stay in their original
+    # order) and keep those that differ from the previous one: the first
+    # occurrence of every unique row
+    order = np.lexsort(canonical.T[::-1])
+    rows = canonical[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]).any(axis=1)
+    keep = np.sort(order[first])
+
+    if tolerance:
+        keep = keep[merge_near_crossings(endpoints[keep], tolerance)]
+
+    return keep
+
+
+def merge_near_crossings(endpoints, tolerance):
+    # Greedily keep crossings that aren't within tolerance of an earlier one,
+    # in both directions. Kept crossings are indexed in a grid of
+    # tolerance-sized cells under both of their endpoints, so a duplicate
+    # is always near the first point of a crossing.
+    grid = geometry.CellGrid(tolerance)
+    cells = grid.cells(endpoints)
+    keep = np.zeros(len(endpoints), dtype=bool)
+
+    for i in range(len(endpoints)):
+        nearby = grid.nearby(cells[i, :2])
+        if nearby:
+            start = endpoints[i, :2]
+            end = endpoints[i, 2:]
+            others = endpoints[nearby]
+            near_start = np.hypot(*(others[:, :2] - start).T) <= tolerance
+            near_end = np.hypot(*(others[:, 2:] - end).T) <= tolerance
+            same = near_start & near_end
+            near_start = np.hypot(*(others[:, 2:] - start).T) <= tolerance
+            near_end = np.hypot(*(others[:, :2] - end).T) <= tolerance
+            reverse = near_start & near_end
+            if (same | reverse).any():
+                continue
+
+        keep[i] = True
+        grid.add(cells[i, :2], i)
+        if tuple(cells[i, 2:]) != tuple(cells[i, :2]):
+            grid.add(cells[i, 2:], i)
+
+    return np.flatnonzero(keep)
 
 
 def cut(line, distance):
@@ -257,35 +724,3 @@ def cut(line, distance):
             return [
                 LineString(coords[:i] + [(cp.x, cp.y)]),
                 LineString([(cp.x, cp.y)] + coords[i:])]
-
-
-def segment_at_distance(line, distance):
-    # Isolate the linestring segment at a specific distance
-    if distance <= 0.0 or distance >= line.length:
-        raise ValueError('Distance < 0 or longer than LineString')
-    coords = list(line.coords)
-    for i, p in enumerate(coords):
-        pd = line.project(Point(p))
-        if pd == distance or pd > distance:
-            # i can't be 0, otherwise distance would be <= 0
-            # Segment located!
-            return LineString(coords[i - 1:i + 1])
-
-
-def dotproduct(segment1, segment2):
-    # It's assumed that the segments are Shapely LineStrings with only two
-    # points: start and end
-    # Create unit vectors so the values are always comparable
-    def unit_vector(segment):
-        coords = np.array(segment.coords)
-        vector = coords[1] - coords[0]
-        unit_vector = vector / segment.length
-
-        return unit_vector
-
-    vector1 = unit_vector(segment1)
-    vector2 = unit_vector(segment2)
-
-    # The dot product measures orthogonality: 0 = perfectly orthogonal, 1
-    # = parallel.
-    return vector1.dot(vector2)
@@ -0,0 +1,211 @@
+'''Concurrent fetching of streets and sidewalks from the Overpass API.
+
+Large areas are split into tiles, and the sidewalks and streets of every tile
+are requested at the same time, a few requests at a time. Failed requests are
+retried with exponential backoff. Every response is cached on disk, so an
+interrupted fetch can be resumed and repeated fetches are free. Ways that
+cross tile edges are returned by several tiles, so results are merged by OSM
+id.'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from http.client import RemoteDisconnected
+import json
+import os
+import socket
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from . import cache, io, tiles
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), '../cache/overpass')
+
+# Width and height of each requested tile, in meters
+TILE_SIZE = 5000
+
+# Number of requests in flight at once
+MAX_REQUESTS = 4
+
+# Number of retries of a failed request, and the delay (seconds) before the
+# first one. The delay doubles on every retry.
+RETRIES = 5
+BACKOFF = 2.0
+
+# Server-side timeout of each query, in seconds
+TIMEOUT = 180
+
+# HTTP status codes worth retrying: rate limiting and overloaded servers
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+SIDEWALKS_FILTER = '["highway"="footway"]["footway"="sidewalk"]'
+
+# Equivalent to osmnx's 'drive' network type
+STREETS_FILTER = '["highway"]' + ''.join(
+    '["{}"!~"{}"]'.format(key, pattern)
+    for key, pattern in sorted(io.DRIVE_EXCLUDE.items()))
+
+
+class OverpassError(Exception):
+    pass
+
+
+# Other errors worth retrying: timeouts, dropped connections and responses
+# cut short (OverpassError). RemoteDisconnected is a ConnectionResetError,
+# but is listed for clarity.
+RETRY_ERRORS = (OverpassError, URLError, socket.timeout, ConnectionResetError,
+                RemoteDisconnected)
+
+
+def fetch_area(bounds, tile_size=TILE_SIZE, url=OVERPASS_URL,
+               max_requests=MAX_REQUESTS, cache_dir=CACHE_DIR):
+    '''Fetch the streets and sidewalks of an area.
+
+    :param bounds: The (west, south, east, north) lon-lat bounding box.
+    :type bounds: list of float
+    :param tile_size: Width and height of each requested tile, in meters.
+    :type tile_size: float
+    :param url: URL of the Overpass API interpreter.
+    :type url: str
+    :param max_requests: Number of requests in flight at once.
+    :type max_requests: int
+    :param cache_dir: Directory where responses are cached, or None to
+                      disable the cache.
+    :type cache_dir: str
+    :returns: The street graph, as returned by io.fetch_street_graph, and the
+              sidewalks, as returned by io.fetch_sidewalks.
+    :rtype: tuple of (networkx.MultiDiGraph, geopandas.GeoDataFrame)
+
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        streets, sidewalks = loop.run_until_complete(
+            fetch_elements(bounds, tile_size, url, max_requests, cache_dir))
+    finally:
+        loop.close()
+
+    G_streets = io.street_graph_from_ways(ways_from_elements(streets),
+                                          bounds)
+    sidewalks = io.sidewalks_from_ways(ways_from_elements(sidewalks))
+
+    return G_streets, sidewalks
+
+
+async def fetch_elements(bounds, tile_size, url, max_requests, cache_dir):
+    # Request the streets and sidewalks of every tile concurrently. Returns
+    # the merged street and sidewalk elements.
+    tile_bounds = [query for _, query in tiles.make_tiles(bounds, tile_size,
+                                                          0)]
+    queries = ([overpass_query(STREETS_FILTER, b) for b in tile_bounds] +
+               [overpass_query(SIDEWALKS_FILTER, b) for b in tile_bounds])
+
+    semaphore = asyncio.Semaphore(max_requests)
+    with ThreadPoolExecutor(max_requests) as executor:
+        responses = await asyncio.gather(
+            *[fetch_query(query, url, semaphore, executor, cache_dir)
+              for query in queries])
+
+    n = len(tile_bounds)
+    return merge_elements(responses[:n]), merge_elements(responses[n:])
+
+
+async def fetch_query(query, url, semaphore, executor, cache_dir):
+    # Run one query, from the cache if possible
+    loop = asyncio.get_event_loop()
+
+    if cache_dir is not None:
+        path = cache_path(query, url, cache_dir)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+
+    async with semaphore:
+        for attempt in range(RETRIES + 1):
+            try:
+                response = await loop.run_in_executor(executor, post, url,
+                                                      query)
+                break
+            except RETRY_ERRORS as e:
+                if (isinstance(e, HTTPError) and
+                        e.code not in RETRY_STATUS):
+                    raise
+                if attempt == RETRIES:
+                    raise
+                await asyncio.sleep(BACKOFF * 2 ** attempt)
+
+    if cache_dir is not None:
+        save_response(response, path)
+
+    return response
+
+
+def post(url, query):
+    # Blocking request to the Overpass API, run in a worker thread
+    data = urlencode({'data': query}).encode()
+    request = Request(url, data=data)
+    with urlopen(request, timeout=TIMEOUT + 30) as f:
+        body = f.read()
+
+    # Overloaded servers sometimes answer 200 with an HTML error page, or the
+    # body is cut short
+    try:
+        response = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise OverpassError('Response is not valid JSON')
+
+    # Queries that time out or run out of memory on the server still succeed,
+    # with a remark and incomplete data
+    remark = response.get('remark', '')
+    if 'runtime error' in remark:
+        raise OverpassError(remark)
+
+    return response
+
+
+def overpass_query(way_filter, bounds):
+    # Ways matching a filter within a bounding box, with their nodes
+    west, south, east, north = bounds
+    return ('[out:json][timeout:{}];'
+            '(way{}({},{},{},{});>;);out;').format(TIMEOUT, way_filter, south,
+                                                   west, north, east)
+
+
+def merge_elements(responses):
+    # Elements of several responses, without duplicates
+    elements = {}
+    for response in responses:
+        for element in response['elements']:
+            elements.setdefault((element['type'], element['id']), element)
+
+    return list(elements.values())
+
+
+def ways_from_elements(elements):
+    # (id, tags, node ids, lon-lat coords) of the ways in Overpass elements,
+    # as used by io.street_graph_from_ways and io.sidewalks_from_ways
+    nodes = {element['id']: (element['lon'], element['lat'])
+             for element in elements if element['type'] == 'node'}
+
+    ways = []
+    for element in elements:
+        if element['type'] != 'way':
+            continue
+        refs = [ref for ref in element['nodes'] if ref in nodes]
+        if len(refs) < 2:
+            continue
+        ways.append((element['id'], element.get('tags', {}), refs,
+                     [nodes[ref] for ref in refs]))
+
+    return ways
+
+
+def cache_path(query, url, cache_dir):
+    key = hashlib.sha1('{}\n{}'.format(url, query).encode()).hexdigest()
+    return os.path.join(cache_dir, '{}.json'.format(key))
+
+
+def save_response(response, path):
+    with cache.atomic_file(path) as f:
+        json.dump(response, f)
@@ -0,0 +1,235 @@
+'''Vectorized geometry operations on flat coordinate arrays.'''
+import numpy as np
+from shapely.geometry import LineString
+
+try:
+    # Shapely 2 converts between geometries and coordinate arrays in bulk
+    from shapely import get_coordinates, linestrings
+except ImportError:
+    get_coordinates = None
+    linestrings = None
+
+
+def line_arrays(geometries):
+    '''Flatten a sequence of LineStrings into a single coordinate array.
+
+    :param geometries: The LineStrings to flatten.
+    :type geometries: list or geopandas.GeoSeries
+    :returns: A (N, 2) array of coordinates and an array of offsets such that
+              the coordinates of line i are coords[offsets[i]:offsets[i + 1]].
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    if get_coordinates is not None:
+        geometries = np.asarray(geometries, dtype=object)
+        coords, index = get_coordinates(geometries, return_index=True)
+        offsets = np.zeros(len(geometries) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(index, minlength=len(geometries)),
+                  out=offsets[1:])
+        return coords, offsets
+
+    coords_list = [np.asarray(geom.coords, dtype=float)[:, :2]
+                   for geom in geometries]
+    offsets = np.zeros(len(coords_list) + 1, dtype=np.intp)
+    if not coords_list:
+        return np.empty((0, 2)), offsets
+
+    np.cumsum([len(coords) for coords in coords_list], out=offsets[1:])
+    coords = np.concatenate(coords_list)
+
+    return coords, offsets
+
+
+def lines_from_arrays(coords, offsets):
+    '''Make LineStrings from flattened coordinates: the inverse of
+    line_arrays.
+
+    :returns: The LineStrings.
+    :rtype: list of shapely.geometry.LineString
+
+    '''
+    if len(offsets) < 2:
+        return []
+    if linestrings is not None:
+        index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return list(linestrings(coords, indices=index))
+    return [LineString(coords[start:end])
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def line_segments(coords, offsets):
+    '''Split flattened lines into their segments.
+
+    :returns: Segment start points, segment end points, and the index of the
+              line that owns each segment.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    n_lines = len(offsets) - 1
+    owner = np.repeat(np.arange(n_lines), np.diff(offsets))
+    # A segment starts at every coordinate except the last one of each line
+    is_start = np.ones(len(coords), dtype=bool)
+    is_start[offsets[1:] - 1] = False
+
+    starts = coords[is_start]
+    ends = coords[np.roll(is_start, 1)]
+    owner = owner[is_start]
+
+    return starts, ends, owner
+
+
+def cumulative_lengths(coords):
+    # Distance along a single line at each of its vertices
+    seg_lengths = np.hypot(*np.diff(coords, axis=0).T)
+    return np.concatenate([[0.0], np.cumsum(seg_lengths)])
+
+
+def interpolate(coords, distances, cumulative=None):
+    '''Find the points at many distances along a single line.'''
+    if cumulative is None:
+        cumulative = cumulative_lengths(coords)
+    distances = np.asarray(distances, dtype=float)
+
+    i = np.searchsorted(cumulative, distances, side='right') - 1
+    i = np.clip(i, 0, len(coords) - 2)
+    seg_length = cumulative[i + 1] - cumulative[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(seg_length > 0, (distances - cumulative[i]) / seg_length,
+                     0.0)
+    t = np.clip(t, 0, 1)
+
+    return coords[i] + (coords[i + 1] - coords[i]) * t[:, np.newaxis]
+
+
+def interpolate_lines(coords, offsets, distances):
+    '''Find one point along each of many flattened lines.
+
+    :param coords: Coordinates of the lines, as returned by line_arrays.
+    :param offsets: Offsets of the lines, as returned by line_arrays.
+    :param distances: Distance along each line.
+    :returns: A (N, 2) array of points.
+    :rtype: numpy.ndarray
+
+    '''
+    lengths = line_lengths(coords, offsets)
+    # Distance along all lines laid end to end, at each vertex
+    cumulative = np.concatenate([[0.0],
+                                 np.cumsum(np.hypot(*np.diff(coords,
+                                                             axis=0).T))])
+    base = cumulative[offsets[:-1]]
+    # Segments joining the end of one line to the start of the next have no
+    # meaning: lines are searched only within their own range of vertices
+    targets = base + np.clip(distances, 0, lengths)
+    i = np.searchsorted(cumulative, targets, side='right') - 1
+    i = np.clip(i, offsets[:-1], offsets[1:] - 2)
+
+    seg_length = cumulative[i + 1] - cumulative[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(seg_length > 0, (targets - cumulative[i]) / seg_length,
+                     0.0)
+    t = np.clip(t, 0, 1)
+
+    return coords[i] + (coords[i + 1] - coords[i]) * t[:, np.newaxis]
+
+
+def line_lengths(coords, offsets):
+    # Length of each flattened line
+    starts, ends, owner = line_segments(coords, offsets)
+    return np.bincount(owner, weights=np.hypot(*(ends - starts).T),
+                       minlength=len(offsets) - 1)
+
+
+def closest_points(points, starts, ends):
+    '''Find the closest point on every segment to every point.
+
+    :param points: (N, 2) array of points.
+    :param starts: (S, 2) array of segment start points.
+    :param ends: (S, 2) array of segment end points.
+    :returns: A (N, S, 2) array of closest points and a (N, S) array of
+              squared distances to them.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    delta = ends - starts
+    length2 = (delta ** 2).sum(axis=1)
+    rel = points[:, np.newaxis, :] - starts[np.newaxis, :, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length2 > 0, (rel * delta).sum(axis=2) / length2, 0.0)
+    t = np.clip(t, 0, 1)
+
+    closest = starts + t[:, :, np.newaxis] * delta
+    dist2 = ((points[:, np.newaxis, :] - closest) ** 2).sum(axis=2)
+
+    return closest, dist2
+
+
+def orientation(a, b, c):
+    # Sign of the cross product (b - a) x (c - a): > 0 means c is to the left
+    # of the a -> b line, < 0 to the right, 0 collinear.
+    return np.sign((b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) -
+                   (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0]))
+
+
+def segments_intersect(p1, p2, q1, q2):
+    '''Test whether segments p1 -> p2 intersect segments q1 -> q2. Inputs are
+    broadcast against each other, so e.g. (N, 1, 2) and (1, M, 2) arrays
+    produce an (N, M) result.'''
+    o1 = orientation(p1, p2, q1)
+    o2 = orientation(p1, p2, q2)
+    o3 = orientation(q1, q2, p1)
+    o4 = orientation(q1, q2, p2)
+
+    crossing = (o1 * o2 <= 0) & (o3 * o4 <= 0)
+
+    # Collinear segments only intersect if their bounding boxes overlap
+    collinear = (o1 == 0) & (o2 == 0)
+    overlap = ((np.minimum(p1[..., 0], p2[..., 0]) <=
+                np.maximum(q1[..., 0], q2[..., 0])) &
+               (np.minimum(q1[..., 0], q2[..., 0]) <=
+                np.maximum(p1[..., 0], p2[..., 0])) &
+               (np.minimum(p1[..., 1], p2[..., 1]) <=
+                np.maximum(q1[..., 1], q2[..., 1])) &
+               (np.minimum(q1[..., 1], q2[..., 1]) <=
+                np.maximum(p1[..., 1], p2[..., 1])))
+
+    return crossing & ~(collinear & ~overlap)
+
+
+def intersection_params(p1, p2, q1, q2):
+    '''Parameter along the q1 -> q2 segments at which the p1 -> p2 segments
+    cross them. Inputs are broadcast against each other. Parallel segments
+    produce nan.'''
+    r = p2 - p1
+    s = q2 - q1
+    denom = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+    qp = q1 - p1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / denom
+    return np.where(denom != 0, u, np.nan)
+
+
+class CellGrid(object):
+    '''Items indexed by position in a grid of square cells. Anything within
+    `size` of a point is in one of the 9 cells around it.
+
+    :param size: Width and height of the cells.
+    :type size: float
+
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.items = {}
+
+    def cells(self, points):
+        # Cells of an (N, 2) array of points, or of both ends of an (N, 4)
+        # array of segments
+        return np.floor(np.asarray(points) / self.size).astype(np.int64)
+
+    def add(self, cell, item):
+        self.items.setdefault((cell[0], cell[1]), []).append(item)
+
+    def nearby(self, cell):
+        # Items in the 9 cells around a cell
+        cx, cy = cell[0], cell[1]
+        return [item for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                for item in self.items.get((cx + dx, cy + dy), ())]
@@ -0,0 +1,193 @@
+'''Support for incremental runs, which only redraw the crossings of
+intersections whose inputs changed since a previous run.
+
+The state of a run maps each intersection node to a hash of its inputs (its
+streets and the sidewalks near them) and the crossings drawn for it.'''
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from . import __version__, cache, intersections, projection, store
+
+
+def load_state(path, crs):
+    '''Load the state of a previous run. If there is no previous state, or it
+    was made by a different version of crossify or in a different coordinate
+    system, an empty state is returned and everything will be recomputed.
+
+    :param path: Path to the state file.
+    :type path: str
+    :param crs: The coordinate reference system crossings are drawn in.
+    :type crs: dict
+    :returns: The state.
+    :rtype: dict
+
+    '''
+    state = {
+        'version': __version__,
+        'crs': projection.crs_name(crs),
+        'intersections': {}
+    }
+
+    if not os.path.exists(path):
+        return state
+
+    with open(path) as f:
+        previous = json.load(f)
+
+    if (previous.get('version') == state['version'] and
+            previous.get('crs') == state['crs']):
+        state['intersections'] = previous['intersections']
+
+    return state
+
+
+def save_state(state, path):
+    # Written next to the state file, then moved into place, so an
+    # interrupted run never leaves a partial state behind
+    with cache.atomic_file(os.path.abspath(path)) as f:
+        json.dump(state, f)
+
+
+def group_hash(ixns, i, sidewalks, offset, sidewalk_keys=None):
+    '''Hash the inputs of an intersection: its streets and the sidewalks
+    near them. This is cheap enough to do for every intersection before
+    anything is drawn: the sidewalks are those whose bounds are within
+    `offset` of the bounds of the streets, a superset of the candidates in
+    the streets' corridors. Sidewalk ids are hashed too, as the crossings
+    refer to them, but not the positions of anything in the input datasets.
+
+    :param ixns: The intersections and their streets.
+    :type ixns: intersections.Intersections
+    :param i: Index of the intersection.
+    :type i: int
+    :param sidewalks: The sidewalks dataset.
+    :type sidewalks: store.Sidewalks
+    :param offset: Width of the search corridor on each side of a street.
+    :type offset: float
+    :param sidewalk_keys: Keys of the sidewalks hashed so far, by position.
+                          Sidewalks are near several intersections, so pass
+                          the same dict for all of them.
+    :type sidewalk_keys: dict
+    :returns: Hex digest of the inputs.
+    :rtype: str
+
+    '''
+    if sidewalk_keys is None:
+        sidewalk_keys = {}
+
+    street_keys = [coords_key(intersections.street_coords(ixns, s),
+                              ixns.street_layer[s])
+                   for s in intersections.streets(ixns, i)]
+
+    # The coordinates of all of the intersection's streets
+    coords = ixns.street_coords[ixns.street_offsets[ixns.offsets[i]]:
+                                ixns.street_offsets[ixns.offsets[i + 1]], :2]
+    if len(coords):
+        minx, miny = coords.min(axis=0) - offset
+        maxx, maxy = coords.max(axis=0) + offset
+        positions = store.query(sidewalks, (minx, miny, maxx, maxy))
+    else:
+        positions = []
+
+    keys = []
+    for position in positions:
+        key = sidewalk_keys.get(position)
+        if key is None:
+            key = (str(sidewalks.ids[position]).encode() + b':' +
+                   coords_key(store.line_coords(sidewalks, position),
+                              sidewalks.layer[position]))
+            sidewalk_keys[position] = key
+        keys.append(key)
+
+    h = hashlib.sha1()
+    for key in sorted(street_keys) + [b'|'] + sorted(keys):
+        h.update(key)
+        h.update(b';')
+
+    return h.hexdigest()
+
+
+def coords_key(coords, layer):
+    # Round to the millimeter to ignore floating point noise
+    coords = np.round(np.asarray(coords, dtype=float)[:, :2], 3)
+    return coords.tobytes() + str(int(layer)).encode()
+
+
+def reuse_crossings(state, hashes):
+    '''Find the intersections whose inputs are unchanged since the previous
+    run and retrieve their crossings.
+
+    :param state: State of the previous run, from load_state.
+    :type state: dict
+    :param hashes: Input hashes for the current intersections, keyed by node.
+    :type hashes: dict
+    :returns: Crossing records (dicts of 'coords' and 'layer') of unchanged
+              intersections, keyed by node.
+    :rtype: dict
+
+    '''
+    previous = state['intersections']
+
+    reused = {}
+    for node, node_hash in hashes.items():
+        entry = previous.get(str(node))
+        if entry is None or entry['hash'] != node_hash:
+            continue
+        # Don't trust crossings that don't match what was recorded
+        if records_hash(entry['crossings']) != entry['output']:
+            continue
+        reused[node] = entry['crossings']
+
+    return reused
+
+
+def update_state(state, hashes, reused, new_crossings, nodes):
+    '''Record the inputs and crossings of every current intersection in the
+    state, dropping intersections that no longer exist.
+
+    :param state: The state, modified in place.
+    :type state: dict
+    :param hashes: Input hashes for the current intersections, keyed by node.
+    :type hashes: dict
+    :param reused: Nodes whose crossings were copied from the previous state.
+    :type reused: iterable
+    :param new_crossings: The newly drawn crossings.
+    :type new_crossings: buffer.CrossingBuffer
+    :param nodes: Intersection nodes, by position.
+    :type nodes: numpy.ndarray
+
+    '''
+    previous = state['intersections']
+
+    records = {str(node): [] for node in hashes if node not in reused}
+    columns = new_crossings.columns()
+    for ixn, coords, layer in zip(columns['ixn'],
+                                  columns['coords'].reshape(-1, 2, 2).tolist(),
+                                  columns['layer'].tolist()):
+        records[str(nodes[ixn])].append({
+            'coords': coords,
+            'layer': layer
+        })
+
+    intersections = {}
+    for node, node_hash in hashes.items():
+        key = str(node)
+        if key in records:
+            node_records = records[key]
+        else:
+            node_records = previous[key]['crossings']
+        intersections[key] = {
+            'hash': node_hash,
+            'crossings': node_records,
+            'output': records_hash(node_records)
+        }
+
+    state['intersections'] = intersections
+
+
+def records_hash(records):
+    dumped = json.dumps(records, sort_keys=True)
+    return hashlib.sha1(dumped.encode()).hexdigest()
@@ -1,64 +1,315 @@
+from collections import namedtuple
+
 import numpy as np
-from shapely.geometry import LineString, Point
+from shapely.geometry import LineString
+
+from . import geometry, validators
+
+
+# Street intersections and the streets radiating out from them, stored as flat
+# arrays. The streets of intersection i are rows offsets[i]:offsets[i + 1] of
+# the street_* arrays, and the coordinates of street s are rows
+# street_offsets[s]:street_offsets[s + 1] of street_coords.
+#
+# Streets shared by two intersections have the same street_edge, an index
+# into edges (u, v, key). street_forward is True when the street radiates
+# from u, the first node of its edge.
+Intersections = namedtuple('Intersections', [
+    'nodes',
+    'x',
+    'y',
+    'offsets',
+    'street_coords',
+    'street_offsets',
+    'street_layer',
+    'street_edge',
+    'street_forward',
+    'edges'
+])
 
 
 def group_intersections(G):
+    '''Find the intersections of a street graph: nodes of degree > 2, with
+    the streets radiating out from them. The graph isn't modified.
+
+    :param G: The street graph, with node 'x' and 'y' attributes and
+              optional edge 'geometry' and 'layer' attributes.
+    :type G: networkx.MultiDiGraph
+    :returns: The intersections and their streets.
+    :rtype: Intersections
+
+    '''
     # FIXME: require undirected graph for degree calcs
+    node_ids = []
+    node_xy = []
+    for node, data in G.nodes(data=True):
+        node_ids.append(node)
+        node_xy.append((data['x'], data['y']))
+    n = len(node_ids)
+    ids = np.asarray(node_ids)
+    node_xy = np.asarray(node_xy, dtype=float).reshape(-1, 2)
+    position = {node: i for i, node in enumerate(node_ids)}
 
-    # Isolate intersections for which to generate crossings
-    intersections = [node for node, degree in G.degree if degree > 2]
+    # Directed edges as node positions. Parallel edges count towards the
+    # degree, but only the first one is used as a street.
+    edge_data = []
+    us = []
+    vs = []
+    for u, v, data in G.edges(data=True):
+        us.append(position[u])
+        vs.append(position[v])
+        edge_data.append(data)
+    us = np.asarray(us, dtype=np.int64)
+    vs = np.asarray(vs, dtype=np.int64)
 
-    # Find all incoming and outgoing streets, associate them with the
-    # intersection, and make sure the geometries all extend out from the node
-    intersection_groups = {}
+    degree = np.bincount(us, minlength=n) + np.bincount(vs, minlength=n)
+    is_intersection = degree > 2
+    ixn_nodes = np.flatnonzero(is_intersection)
+    ixn_index = np.full(n, -1, dtype=np.intp)
+    ixn_index[ixn_nodes] = np.arange(len(ixn_nodes))
 
-    for intersection_id in intersections:
-        data = G.node[intersection_id]
-        intersection = Point(data['x'], data['y'])
+    pair_keys, first = np.unique(us * n + vs, return_index=True)
+    pair_u = us[first]
+    pair_v = vs[first]
 
-        # Two-way streets will produce two edges: one in, one out. We will keep
-        # only the outgoing one
-        incoming = set(G.predecessors(intersection_id))
-        outgoing = set(G.successors(intersection_id))
-        incoming = incoming.difference(outgoing)
+    # Two-way streets will produce two edges: one in, one out. We will keep
+    # only the outgoing one
+    reverse_keys = pair_v * n + pair_u
+    found = np.searchsorted(pair_keys, reverse_keys)
+    found = np.minimum(found, len(pair_keys) - 1)
+    has_reverse = pair_keys[found] == reverse_keys
 
-        edges = []
-        for node in incoming:
-            edges.append(get_edge(G, node, intersection_id))
+    outgoing = np.flatnonzero(is_intersection[pair_u])
+    incoming = np.flatnonzero(is_intersection[pair_v] & ~has_reverse)
+    row_pair = np.concatenate([incoming, outgoing])
+    row_node = np.concatenate([pair_v[incoming], pair_u[outgoing]])
+    row_other = np.concatenate([pair_u[incoming], pair_v[outgoing]])
+    row_incoming = np.arange(len(row_pair)) < len(incoming)
 
-        for node in outgoing:
-            edges.append(get_edge(G, intersection_id, node))
+    # Streets of each intersection are contiguous: incoming, then outgoing
+    order = np.lexsort((row_other, ~row_incoming, ixn_index[row_node]))
+    row_pair = row_pair[order]
+    row_node = row_node[order]
+    row_other = row_other[order]
 
-        # Make sure all streets radiate out from the intersection
-        edges_ordered = []
-        for i, edge in enumerate(edges):
-            copy = edge.copy()
-            point = Point(*edge['geometry'].coords[-1])
-            if point.distance(intersection) < 1e-1:
-                reversed_street = LineString(edge['geometry'].coords[::-1])
-                copy['geometry'] = reversed_street
-            edges_ordered.append(copy)
+    counts = np.bincount(ixn_index[row_node], minlength=len(ixn_nodes))
+    offsets = np.zeros(len(ixn_nodes) + 1, dtype=np.intp)
+    np.cumsum(counts, out=offsets[1:])
 
-        intersection_groups[intersection_id] = {
-            'geometry': intersection,
-            'streets': edges_ordered
-        }
+    # Coordinates of every edge used by a street, straight lines for edges
+    # without a geometry
+    used, row_used = np.unique(row_pair, return_inverse=True)
+    used_coords = []
+    used_layers = []
+    for p in used:
+        data = edge_data[first[p]]
+        if data.get('geometry') is None:
+            coords = node_xy[[pair_u[p], pair_v[p]]]
+        else:
+            coords = np.asarray(data['geometry'].coords)[:, :2]
+        used_coords.append(coords)
+        used_layers.append(data.get('layer', 0))
+    used_lengths = np.array([len(c) for c in used_coords], dtype=np.intp)
+    used_starts = np.zeros(len(used), dtype=np.intp)
+    np.cumsum(used_lengths[:-1], out=used_starts[1:])
+    if used_coords:
+        used_coords = np.concatenate(used_coords)
+    else:
+        used_coords = np.empty((0, 2))
+    used_layers = validators.layer_values(used_layers)
 
-    return intersection_groups
+    # Make sure all streets radiate out from the intersection: reverse those
+    # that end at it
+    lengths = used_lengths[row_used]
+    starts = used_starts[row_used]
+    ends = used_coords[starts + lengths - 1]
+    reverse = np.hypot(*(ends - node_xy[row_node]).T) < 1e-1
 
+    street_offsets = np.zeros(len(row_pair) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=street_offsets[1:])
+    along = (np.arange(street_offsets[-1]) -
+             np.repeat(street_offsets[:-1], lengths))
+    along = np.where(np.repeat(reverse, lengths),
+                     np.repeat(lengths, lengths) - 1 - along, along)
+    street_coords = used_coords[np.repeat(starts, lengths) + along]
 
-def get_edge(G, from_node, to_node):
-    edge = G[from_node][to_node][0]
+    # Both ends of a street share the same edge, regardless of which
+    # directed edge was used. Edges are numbered in order of appearance.
+    forward = ids[row_node] <= ids[row_other]
+    edge_u = np.where(forward, row_node, row_other)
+    edge_v = np.where(forward, row_other, row_node)
+    _, edge_first, edge_inverse = np.unique(edge_u * n + edge_v,
+                                            return_index=True,
+                                            return_inverse=True)
+    edge_order = np.argsort(edge_first)
+    edge_rank = np.empty(len(edge_order), dtype=np.intp)
+    edge_rank[edge_order] = np.arange(len(edge_order))
+    edge_first = edge_first[edge_order]
+    edges = np.column_stack([ids[edge_u[edge_first]],
+                             ids[edge_v[edge_first]],
+                             np.zeros(len(edge_first), dtype=int)])
 
-    if 'geometry' not in edge:
-        start = Point((G.nodes[from_node]['x'], G.nodes[from_node]['y']))
-        end = Point((G.nodes[to_node]['x'], G.nodes[to_node]['y']))
-        edge['geometry'] = LineString([start, end])
+    return Intersections(
+        nodes=ids[ixn_nodes],
+        x=node_xy[ixn_nodes, 0],
+        y=node_xy[ixn_nodes, 1],
+        offsets=offsets,
+        street_coords=street_coords,
+        street_offsets=street_offsets,
+        street_layer=used_layers[row_used],
+        street_edge=edge_rank[edge_inverse.ravel()],
+        street_forward=forward,
+        edges=edges
+    )
+
+
+def select(ixns, mask):
+    '''Keep a subset of the intersections.
+
+    :param ixns: The intersections.
+    :type ixns: Intersections
+    :param mask: Which intersections to keep.
+    :type mask: numpy.ndarray of bool
+    :returns: The selected intersections and their streets.
+    :rtype: Intersections
+
+    '''
+    keep = np.flatnonzero(mask)
+    keep_streets = np.concatenate([streets(ixns, i)
+                                   for i in keep] +
+                                  [np.empty(0, dtype=np.intp)])
+    counts = np.diff(ixns.offsets)[keep]
+
+    return _regroup(ixns, keep, keep_streets, counts)
+
+
+def cluster_intersections(ixns, radius):
+    '''Group intersections into complex intersections, such as the two
+    carriageways of a divided road or the nodes of a boulevard. Intersections
+    within `radius` of each other that have streets on the same layer are in
+    the same cluster, as are their neighbors' neighbors.
+
+    :param ixns: The intersections.
+    :type ixns: Intersections
+    :param radius: Distance between the intersections of a cluster.
+    :type radius: float
+    :returns: The cluster of each intersection, numbered in order of their
+              first intersection.
+    :rtype: numpy.ndarray of int
+
+    '''
+    n = len(ixns.nodes)
+    parent = list(range(n))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if radius > 0 and n:
+        layers = [set(ixns.street_layer[ixns.offsets[i]:
+                                        ixns.offsets[i + 1]].tolist())
+                  for i in range(n)]
+
+        # Intersections are indexed in a grid of radius-sized cells as
+        # they're visited, so every earlier neighbor is nearby
+        xy = np.column_stack([ixns.x, ixns.y])
+        grid = geometry.CellGrid(radius)
+        cells = grid.cells(xy)
+        for i in range(n):
+            nearby = grid.nearby(cells[i])
+            if nearby:
+                near = np.hypot(*(xy[nearby] - xy[i]).T) <= radius
+                for j, is_near in zip(nearby, near):
+                    if is_near and layers[i] & layers[j]:
+                        parent[root(i)] = root(j)
+            grid.add(cells[i], i)
+
+    roots = np.array([root(i) for i in range(n)], dtype=np.intp)
+    _, first, labels = np.unique(roots, return_index=True,
+                                 return_inverse=True)
+    rank = np.empty(len(first), dtype=np.intp)
+    rank[np.argsort(first)] = np.arange(len(first))
+
+    return rank[labels.ravel()]
+
+
+def merge(ixns, labels):
+    '''Merge clusters of intersections into one intersection each, at the
+    position of their first intersection. A cluster has the streets of all of
+    its intersections except the connectors between them, which aren't
+    crossed.
+
+    :param ixns: The intersections.
+    :type ixns: Intersections
+    :param labels: The cluster of each intersection, numbered in order of
+                   their first intersection (see cluster_intersections).
+    :type labels: numpy.ndarray of int
+    :returns: The merged intersections and their streets.
+    :rtype: Intersections
+
+    '''
+    n_clusters = labels.max() + 1 if len(labels) else 0
+    _, first = np.unique(labels, return_index=True)
+
+    street_ixn = np.repeat(np.arange(len(ixns.nodes)), np.diff(ixns.offsets))
+    street_cluster = labels[street_ixn]
+
+    # The intersection at the other end of each street, if any
+    edges = ixns.edges[ixns.street_edge]
+    other = np.where(ixns.street_forward, edges[:, 1], edges[:, 0])
+    sorter = np.argsort(ixns.nodes)
+    found = np.searchsorted(ixns.nodes, other, sorter=sorter)
+    other_ixn = sorter[np.minimum(found, len(sorter) - 1)]
+    is_ixn = ixns.nodes[other_ixn] == other
+    connector = (is_ixn & (other_ixn != street_ixn) &
+                 (labels[other_ixn] == street_cluster))
+
+    keep_streets = np.flatnonzero(~connector)
+    keep_streets = keep_streets[np.argsort(street_cluster[keep_streets],
+                                           kind='stable')]
+    counts = np.bincount(street_cluster[keep_streets], minlength=n_clusters)
+
+    return _regroup(ixns, first, keep_streets, counts)
+
+
+def _regroup(ixns, keep, keep_streets, counts):
+    # Intersections keep of ixns with new lists of streets: the first
+    # counts[0] of keep_streets belong to the first one, etc.
+    offsets = np.zeros(len(keep) + 1, dtype=np.intp)
+    np.cumsum(counts, out=offsets[1:])
+
+    lengths = np.diff(ixns.street_offsets)[keep_streets]
+    street_offsets = np.zeros(len(keep_streets) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=street_offsets[1:])
+    shift = ixns.street_offsets[keep_streets] - street_offsets[:-1]
+    coords = ixns.street_coords[np.arange(street_offsets[-1]) +
+                                np.repeat(shift, lengths)]
+
+    return Intersections(
+        nodes=ixns.nodes[keep],
+        x=ixns.x[keep],
+        y=ixns.y[keep],
+        offsets=offsets,
+        street_coords=coords,
+        street_offsets=street_offsets,
+        street_layer=ixns.street_layer[keep_streets],
+        street_edge=ixns.street_edge[keep_streets],
+        street_forward=ixns.street_forward[keep_streets],
+        edges=ixns.edges
+    )
+
+
+def streets(ixns, i):
+    # Indices of the streets radiating from intersection i
+    return np.arange(ixns.offsets[i], ixns.offsets[i + 1])
+
+
+def street_coords(ixns, s):
+    return ixns.street_coords[ixns.street_offsets[s]:
+                              ixns.street_offsets[s + 1]]
 
-    if 'layer' in edge:
-        if edge['layer'] is np.nan:
-            edge['layer'] = 0
-    else:
-        edge['layer'] = 0
 
-    return edge
+def street_geometry(ixns, s):
+    return LineString(street_coords(ixns, s))
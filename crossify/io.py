@@ -1,28 +1,50 @@
+import json
 import os
+import re
 import shutil
 from tempfile import mkdtemp
 
+import fiona
 import geopandas as gpd
-import osmnx as ox
-import overpass
-from shapely.geometry import shape
+import numpy as np
+from shapely.geometry import LineString, box, mapping, shape
 
-from . import validators
+from . import projection, validators
+
+# osmnx and overpass are only imported when data is fetched: they're slow to
+# import and not needed for local files
 
 
 def read_sidewalks(path):
     sidewalks = gpd.read_file(path)
 
-    # Validate/convert input geometries, e.g. all LineStrings.
-    sidewalks = validators.validate_sidewalks(sidewalks)
+    # Validate/convert input geometries, e.g. all LineStrings. They're left
+    # in their own coordinate system: drawing crossings projects them once.
+    return validators.validate_sidewalks(sidewalks)
+
+
+def read_sidewalks_bbox(path, west, south, east, north):
+    # Read only the sidewalks that intersect a lon-lat bounding box
+    bbox = gpd.GeoSeries([box(west, south, east, north)])
+    bbox.crs = {'init': 'epsg:4326'}
+    sidewalks = gpd.read_file(path, bbox=bbox)
 
-    # Use WGS84 to start
-    sidewalks_wgs84 = sidewalks.to_crs({'init': 'epsg:4326'})
+    if sidewalks.empty:
+        sidewalks.crs = {'init': 'epsg:4326'}
+        return sidewalks
 
-    return sidewalks_wgs84
+    return validators.validate_sidewalks(sidewalks)
+
+
+def sidewalks_bounds(path):
+    # Lon-lat bounds of a sidewalks file, without reading its features
+    with fiona.open(path) as c:
+        return projection.lonlat_bounds(c.bounds, c.crs)
 
 
 def fetch_sidewalks(west, south, east, north):
+    import overpass
+
     api = overpass.API()
     footpaths_filter = '[highway=footway][footway=sidewalk]'
     response = api.Get('way{}({},{},{},{})'.format(footpaths_filter, south,
@@ -40,53 +62,384 @@ def fetch_sidewalks(west, south, east, north):
     return gdf
 
 
-def fetch_street_graph(sidewalks):
-    # Just in case, attempt to reproject
-    sidewalks = sidewalks.to_crs({'init': 'epsg:4326'})
-    west, south, east, north = sidewalks.total_bounds
+def fetch_street_graph(sidewalks, bounds=None):
+    import osmnx as ox
+
+    if bounds is None:
+        # Just in case, attempt to reproject
+        sidewalks = sidewalks.to_crs({'init': 'epsg:4326'})
+        west, south, east, north = sidewalks.total_bounds
+    else:
+        west, south, east, north = bounds
     G_streets = ox.graph_from_bbox(north, south, east, west,
                                    network_type='drive')
 
     return G_streets
 
 
-def write_crossings(crossings, path):
-    # Just in case, attempt to reproject
-    crossings = crossings.to_crs({'init': 'epsg:4326'})
+# Ways that osmnx's 'drive' network type excludes: a way is skipped when the
+# value of any of these tags matches the pattern
+DRIVE_EXCLUDE = {
+    'area': 'yes',
+    'highway': 'cycleway|footway|path|pedestrian|steps|track|corridor|'
+               'proposed|construction|bridleway|abandoned|platform|raceway|'
+               'service',
+    'motor_vehicle': 'no',
+    'motorcar': 'no',
+    'access': 'private',
+    'service': 'parking|parking_aisle|driveway|private|emergency_access'
+}
+
+
+def is_drive_way(tags):
+    if 'highway' not in tags:
+        return False
+    for key, pattern in DRIVE_EXCLUDE.items():
+        if key in tags and re.search(pattern, tags[key]):
+            return False
+    return True
+
+
+def is_sidewalk_way(tags):
+    return (tags.get('highway') == 'footway' and
+            tags.get('footway') == 'sidewalk')
+
+
+def read_osm_extract(path, bounds=None):
+    '''Read streets and sidewalks from a local OpenStreetMap extract (.osm.pbf,
+    .osm, or any other format osmium supports) in a single streaming pass,
+    instead of fetching them from the Overpass API. Requires the osmium
+    package.
+
+    :param path: Path to the extract.
+    :type path: str
+    :param bounds: Optional (west, south, east, north) lon-lat bounding box.
+                   Only ways with a node inside of it are read.
+    :type bounds: list of float
+    :returns: The street graph, as returned by fetch_street_graph, and the
+              sidewalks, as returned by fetch_sidewalks.
+    :rtype: tuple of (networkx.MultiDiGraph, geopandas.GeoDataFrame)
+
+    '''
+    streets, sidewalks = parse_osm_extract(path, bounds)
+
+    G_streets = street_graph_from_ways(streets, bounds)
+
+    return G_streets, sidewalks_from_ways(sidewalks)
+
+
+def street_graph_from_ways(ways, bounds=None):
+    # Build a street graph with osmnx from (id, tags, node ids, lon-lat
+    # coords) ways, giving it the same kind of response it gets from
+    # Overpass
+    import osmnx as ox
+
+    nodes = {}
+    elements = []
+    for way_id, tags, refs, coords in ways:
+        for ref, (lon, lat) in zip(refs, coords):
+            nodes[ref] = {'type': 'node', 'id': ref, 'lon': lon, 'lat': lat}
+        elements.append({'type': 'way', 'id': way_id, 'nodes': refs,
+                         'tags': tags})
+    response = {'elements': list(nodes.values()) + elements}
+
+    G_streets = ox.create_graph([response], network_type='drive')
+    if bounds is not None:
+        west, south, east, north = bounds
+        G_streets = ox.truncate_graph_bbox(G_streets, north, south, east,
+                                           west, retain_all=True)
+    G_streets = ox.simplify_graph(G_streets)
+    G_streets = ox.get_largest_component(G_streets)
+
+    return G_streets
 
-    # Create a temporary directory and attempt to write the file
-    tempdir = mkdtemp()
-    tempfile = os.path.join(tempdir, 'crossings.geojson')
 
-    # TODO: Check if extension is .osm and if so, apply proper schema and
-    # osmify (user osmizer?)
+def sidewalks_from_ways(ways):
+    # Sidewalks GeoDataFrame from (id, tags, node ids, lon-lat coords) ways,
+    # with the same columns as fetch_sidewalks
+    rows = []
+    for way_id, tags, refs, coords in ways:
+        data = dict(tags)
+        data['geometry'] = LineString(coords)
+        rows.append(data)
 
+    gdf = gpd.GeoDataFrame(rows)
+    gdf.crs = {'init': 'epsg:4326'}
+
+    return gdf
+
+
+def parse_osm_extract(path, bounds=None):
+    # Collect the (id, tags, node ids, lon-lat coords) of drivable streets and
+    # sidewalks. Node locations are only held for as long as osmium needs
+    # them to resolve way geometries.
     try:
-        crossings.to_file(tempfile, driver='GeoJSON')
-    except Exception as e:
-        shutil.rmtree(tempdir)
-        raise e
+        import osmium
+    except ImportError:
+        raise ImportError('Reading OSM extracts requires the osmium package '
+                          '(pip install osmium)')
 
-    # Writing was successful, so move the file to the correct path
-    shutil.move(tempfile, path)
+    if bounds is not None:
+        west, south, east, north = bounds
 
+    streets = []
+    sidewalks = []
 
-def write_sidewalk_links(links, path):
-    # Just in case, attempt to reproject
-    links = links.to_crs({'init': 'epsg:4326'})
+    class Handler(osmium.SimpleHandler):
+        def way(self, w):
+            tags = {tag.k: tag.v for tag in w.tags}
+            if is_drive_way(tags):
+                ways = streets
+            elif is_sidewalk_way(tags):
+                ways = sidewalks
+            else:
+                return
 
-    # Create a temporary directory and attempt to write the file
-    tempdir = mkdtemp()
-    tempfile = os.path.join(tempdir, 'links.geojson')
+            refs = []
+            coords = []
+            for node in w.nodes:
+                if not node.location.valid():
+                    continue
+                refs.append(node.ref)
+                coords.append((node.location.lon, node.location.lat))
+            if len(coords) < 2:
+                return
 
-    # TODO: Check if extension is .osm and if so, apply proper schema and
-    # osmify (user osmizer?)
+            if bounds is not None:
+                lon, lat = np.asarray(coords).T
+                inside = ((west <= lon) & (lon <= east) &
+                          (south <= lat) & (lat <= north))
+                if not inside.any():
+                    return
 
+            ways.append((w.id, tags, refs, coords))
+
+    Handler().apply_file(path, locations=True)
+
+    return streets, sidewalks
+
+
+def write_crossings(crossings, path):
+    # The format is chosen from the file extension
+    write_frame(crossings, path)
+
+
+def write_sidewalk_links(links, path):
+    write_frame(links, path)
+
+
+def write_frame(gdf, path):
+    writer = open_writer(path)
     try:
-        links.to_file(tempfile, driver='GeoJSON')
-    except Exception as e:
-        shutil.rmtree(tempdir)
-        raise e
+        writer.write(gdf)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def open_writer(path):
+    '''Open a writer for the output format matching the extension of a path:
+    GeoJSON (.geojson, .json), GeoParquet (.parquet) or FlatGeobuf (.fgb).
+
+    :param path: The output path.
+    :type path: str
+    :returns: A writer that accepts GeoDataFrames in batches.
+    :rtype: OutputWriter
+
+    '''
+    return WRITERS[output_format(path)](path)
+
+
+def output_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in EXTENSIONS:
+        raise ValueError('Unsupported output format \'{}\': use one of '
+                         '{}'.format(ext, ', '.join(sorted(EXTENSIONS))))
+    return EXTENSIONS[ext]
+
+
+class OutputWriter(object):
+    '''Base class for writers that write GeoDataFrames to a single file in
+    batches, so that the whole dataset never has to be held in memory. The
+    output is written to a temporary file and only moved to its final path
+    once complete. Batches are reprojected to WGS84, unless they already are.
+
+    :param path: The output path.
+    :type path: str
+
+    '''
+    extension = ''
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+        self.tempdir = mkdtemp()
+        self.tempfile = os.path.join(self.tempdir, 'output' + self.extension)
+
+    def write(self, gdf):
+        gdf = projection.project_frame(gdf, projection.WGS84)
+        self.write_batch(gdf)
+        self.count += len(gdf)
+
+    def write_batch(self, gdf):
+        raise NotImplementedError
+
+    def finish(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.finish()
+
+        # Writing was successful, so move the file to the correct path
+        shutil.move(self.tempfile, self.path)
+        shutil.rmtree(self.tempdir)
+
+    def abort(self):
+        try:
+            self.finish()
+        finally:
+            shutil.rmtree(self.tempdir)
+
+
+class GeoJSONWriter(OutputWriter):
+    extension = '.geojson'
+
+    def __init__(self, path):
+        super(GeoJSONWriter, self).__init__(path)
+        self.f = open(self.tempfile, 'w')
+        self.f.write('{"type": "FeatureCollection", "features": [\n')
+
+    def write_batch(self, gdf):
+        columns = [c for c in gdf.columns if c != 'geometry']
+
+        for i, (geom, values) in enumerate(
+                zip(gdf['geometry'], gdf[columns].itertuples(index=False))):
+            feature = {
+                'type': 'Feature',
+                'geometry': mapping(geom),
+                'properties': {c: json_value(v)
+                               for c, v in zip(columns, values)}
+            }
+            if self.count or i:
+                self.f.write(',\n')
+            self.f.write(json.dumps(feature))
+
+    def finish(self):
+        self.f.write('\n]}\n')
+        self.f.close()
+
+
+class GeoParquetWriter(OutputWriter):
+    '''Writes GeoParquet: one row group per batch, with geometries encoded as
+    WKB. The columns of the first batch determine the schema. Requires the
+    pyarrow package.'''
+    extension = '.parquet'
+
+    def __init__(self, path):
+        super(GeoParquetWriter, self).__init__(path)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Writing GeoParquet requires the pyarrow '
+                              'package (pip install pyarrow)')
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.writer = None
+
+    def write_batch(self, gdf):
+        df = gdf.drop('geometry', axis=1)
+        df['geometry'] = [geom.wkb for geom in gdf['geometry']]
+
+        if self.writer is None:
+            table = self.pa.Table.from_pandas(df, preserve_index=False)
+            self.open(table.schema)
+        else:
+            table = self.pa.Table.from_pandas(df, schema=self.writer.schema,
+                                              preserve_index=False)
+        self.writer.write_table(table)
+
+    def open(self, schema):
+        # Coordinates are WGS84 longitude-latitude, GeoParquet's default CRS,
+        # so none is recorded
+        geo = {
+            'version': '1.0.0',
+            'primary_column': 'geometry',
+            'columns': {
+                'geometry': {'encoding': 'WKB', 'geometry_types': []}
+            }
+        }
+        metadata = dict(schema.metadata or {})
+        metadata[b'geo'] = json.dumps(geo).encode()
+        self.writer = self.pq.ParquetWriter(self.tempfile,
+                                            schema.with_metadata(metadata))
+
+    def finish(self):
+        if self.writer is None:
+            self.open(self.pa.schema([('geometry', self.pa.binary())]))
+        self.writer.close()
+
+
+class FlatGeobufWriter(OutputWriter):
+    '''Writes FlatGeobuf, which includes a spatial index for fast reads of
+    an area. The columns of the first batch determine the schema.'''
+    extension = '.fgb'
+
+    def __init__(self, path):
+        super(FlatGeobufWriter, self).__init__(path)
+        self.collection = None
+
+    def write_batch(self, gdf):
+        columns = [c for c in gdf.columns if c != 'geometry']
+        if self.collection is None:
+            self.open({c: fiona_type(gdf[c].dtype) for c in columns})
+
+        self.collection.writerecords({
+            'geometry': mapping(geom),
+            'properties': {c: json_value(v) for c, v in zip(columns, values)}
+        } for geom, values in zip(gdf['geometry'],
+                                  gdf[columns].itertuples(index=False)))
+
+    def open(self, properties):
+        schema = {'geometry': 'LineString', 'properties': properties}
+        self.collection = fiona.open(self.tempfile, 'w', driver='FlatGeobuf',
+                                     schema=schema,
+                                     crs={'init': 'epsg:4326'})
+
+    def finish(self):
+        if self.collection is None:
+            self.open({})
+        self.collection.close()
+
+
+EXTENSIONS = {
+    '.geojson': 'geojson',
+    '.json': 'geojson',
+    '.parquet': 'parquet',
+    '.fgb': 'flatgeobuf'
+}
+
+WRITERS = {
+    'geojson': GeoJSONWriter,
+    'parquet': GeoParquetWriter,
+    'flatgeobuf': FlatGeobufWriter
+}
+
+
+def fiona_type(dtype):
+    if dtype.kind in 'iub':
+        return 'int'
+    if dtype.kind == 'f':
+        return 'float'
+    return 'str'
+
 
-    # Writing was successful, so move the file to the correct path
-    shutil.move(tempfile, path)
+def json_value(value):
+    # Convert numpy scalars and missing values to their JSON equivalents
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
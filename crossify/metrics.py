@@ -0,0 +1,145 @@
+'''Timing, memory and item counts for the stages of a run.'''
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import json
+import math
+import sys
+import time
+
+
+class Metrics(object):
+    '''Metrics of a run: a record for every stage, counters that stages can
+    increment, e.g. the reasons crossing candidates were rejected, and
+    distributions of per-item values, e.g. the number of candidates evaluated
+    for each intersection.
+
+    Stages run more than once (e.g. once per tile) accumulate their time,
+    calls, items and memory increase.'''
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counters = Counter()
+        self.samples = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        '''Record the wall time, CPU time (including that of worker processes)
+        and memory use of a stage. Yields the stage's record, in which the
+        number of items the stage produced can be set.
+
+        The operating system only reports the high-water mark of the
+        resident set size over the life of the process, so a stage records
+        it as it was at the end of the stage (max_rss_mb) and how much the
+        stage raised it (max_rss_increase_mb). A stage that only uses memory
+        freed by earlier stages has no increase. max_rss_children_mb is the
+        high-water mark of the largest finished worker process. Memory use
+        is None where it isn't available (Windows).'''
+        record = self.stages.setdefault(name, {
+            'calls': 0,
+            'items': None,
+            'seconds': 0.0,
+            'cpu_seconds': 0.0,
+            'max_rss_mb': 0.0,
+            'max_rss_increase_mb': 0.0,
+            'max_rss_children_mb': 0.0
+        })
+        items = record['items']
+        record['items'] = None
+
+        start = time.time()
+        start_cpu = cpu_time()
+        start_rss = max_rss()
+        try:
+            yield record
+        finally:
+            record['calls'] += 1
+            record['seconds'] += time.time() - start
+            record['cpu_seconds'] += cpu_time() - start_cpu
+            record['max_rss_mb'] = max_rss()
+            if record['max_rss_mb'] is None:
+                record['max_rss_increase_mb'] = None
+            else:
+                record['max_rss_increase_mb'] += (record['max_rss_mb'] -
+                                                  start_rss)
+            record['max_rss_children_mb'] = max_rss(children=True)
+            if items is not None:
+                record['items'] = items + (record['items'] or 0)
+
+    def observe(self, name, values):
+        # Add values to a distribution
+        self.samples.setdefault(name, []).extend(values)
+
+    def distributions(self):
+        # Summaries of every distribution (see summarize)
+        return OrderedDict((name, summarize(values))
+                           for name, values in self.samples.items())
+
+    def to_dict(self):
+        return {
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'distributions': self.distributions()
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+
+def cpu_time():
+    # User and system time of this process and of its finished children.
+    # Without the resource module (Windows), only that of this process.
+    try:
+        import resource
+    except ImportError:
+        return time.process_time()
+
+    usage = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        rusage = resource.getrusage(who)
+        usage += rusage.ru_utime + rusage.ru_stime
+    return usage
+
+
+def summarize(values):
+    '''Summarize a distribution: the number of values, their mean, maximum
+    and 50th, 90th and 99th percentiles (nearest rank).
+
+    :param values: The values.
+    :type values: list of float
+    :returns: The summary. Everything but the count is None if there are no
+              values.
+    :rtype: dict
+
+    '''
+    values = sorted(values)
+    summary = OrderedDict([('count', len(values))])
+    for key in ('mean', 'max', 'p50', 'p90', 'p99'):
+        summary[key] = None
+    if not values:
+        return summary
+
+    summary['mean'] = sum(values) / len(values)
+    summary['max'] = values[-1]
+    for q in (50, 90, 99):
+        rank = max(1, int(math.ceil(q / 100.0 * len(values))))
+        summary['p{}'.format(q)] = values[rank - 1]
+
+    return summary
+
+
+def max_rss(children=False):
+    # High-water mark of the resident set size (megabytes) of this process,
+    # or of its largest finished child. None without the resource module,
+    # which only exists on Unix.
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return maxrss / 1024.0
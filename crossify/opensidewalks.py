@@ -1,33 +1,57 @@
 import geopandas as gpd
+import numpy as np
 from shapely.geometry import LineString
 
+from . import geometry
+
 
 def make_links(st_crossings, offset=1):
+    '''Trim crossings back from the sidewalks and connect them to the
+    sidewalks with short links, following the OpenSidewalks schema. Crossings
+    no longer than twice the offset are left as they are.
+
+    :param st_crossings: The crossings.
+    :type st_crossings: geopandas.GeoDataFrame
+    :param offset: Length of each link.
+    :type offset: float
+    :returns: New crossings and links frames. The input is not modified.
+    :rtype: tuple of geopandas.GeoDataFrame
+
+    '''
     crs = st_crossings.crs
 
-    links = []
-    for idx, row in st_crossings.iterrows():
-        geom = row.geometry
-        if geom.length > (2 * offset):
-            first = geom.interpolate(offset)
-            last = geom.interpolate(geom.length - offset)
-
-            sw1 = LineString([geom.coords[0], first])
-            sw2 = LineString([geom.coords[-1], last])
-            new_geom = LineString([first, last])
-
-            for link in [sw1, sw2]:
-                links.append({
-                    'geometry': link,
-                    'highway': 'footway',
-                    'footway': 'sidewalk',
-                    'layer': row['layer']
-                })
-            st_crossings.loc[idx, 'geometry'] = new_geom
-
-    sw_links = gpd.GeoDataFrame(links)
-
+    coords, offsets = geometry.line_arrays(st_crossings.geometry)
+    lengths = geometry.line_lengths(coords, offsets)
+    long = np.flatnonzero(lengths > (2 * offset))
+
+    first_coords = coords[offsets[long]]
+    last_coords = coords[offsets[long + 1] - 1]
+    first = geometry.interpolate_lines(coords, offsets,
+                                       np.full(len(lengths), float(offset)))
+    last = geometry.interpolate_lines(coords, offsets, lengths - offset)
+    first = first[long]
+    last = last[long]
+
+    geoms = list(st_crossings.geometry)
+    for i, pair in zip(long, np.stack([first, last], axis=1)):
+        geoms[i] = LineString(pair)
+    new_crossings = st_crossings.copy()
+    new_crossings['geometry'] = geoms
+    new_crossings = gpd.GeoDataFrame(new_crossings)
+    new_crossings.crs = crs
+
+    # Links from each end of the crossing to its trimmed end, in order
+    link_coords = np.stack([
+        np.stack([first_coords, first], axis=1),
+        np.stack([last_coords, last], axis=1)
+    ], axis=1).reshape(-1, 2, 2)
+    sw_links = gpd.GeoDataFrame({
+        'geometry': [LineString(pair) for pair in link_coords],
+        'highway': 'footway',
+        'footway': 'sidewalk'
+    }, columns=['geometry', 'highway', 'footway'])
+    if 'layer' in st_crossings.columns:
+        sw_links['layer'] = np.repeat(st_crossings['layer'].values[long], 2)
     sw_links.crs = crs
-    st_crossings.crs = crs
 
-    return st_crossings, sw_links
+    return new_crossings, sw_links
@@ -0,0 +1,314 @@
+'''The stages of a command line run: preparing the street network, drawing
+crossings and writing them, for a whole area at once (core) or one tile at a
+time (core_tiled). Progress messages are printed with click.
+
+Like the command line application, which imports this module, modules that
+depend on geopandas, osmnx, etc. are imported by the functions that need
+them.'''
+from os import path
+
+import click
+
+from .metrics import Metrics
+
+
+# Have to add extra layers
+# FIXME: 'layer' is not correctly processed in osmnx. Other tags get turned
+# into arrays if the ways get combined. Also, ways shouldn't be combined if
+# they they are on different layers anyways, so may need to drop osmnx /
+# simplify ourselves
+USEFUL_TAGS_PATH = ['access', 'area', 'bridge', 'est_width', 'highway',
+                    'landuse', 'lanes', 'oneway', 'maxspeed', 'name', 'ref',
+                    'service', 'tunnel', 'width', 'layer']
+
+
+def configure_osmnx():
+    # Only needed when osmnx fetches or builds a street network
+    import osmnx as ox
+
+    ox.utils.config(cache_folder=path.join(path.dirname(__file__),
+                                           '../cache'),
+                    useful_tags_path=USEFUL_TAGS_PATH,
+                    use_cache=True)
+
+
+def core(sidewalks, outfile, opensidewalks=False, state_path=None,
+         G_streets=None, metrics=None, **options):
+    from . import io
+    from .api import osm_schema
+
+    if metrics is None:
+        metrics = Metrics()
+
+    st_crossings = draw_crossings(sidewalks, state_path=state_path,
+                                  G_streets=G_streets, metrics=metrics,
+                                  **options)
+    if st_crossings is None:
+        click.echo('Failed to make any crossings!')
+        return
+
+    #
+    # Write to file
+    #
+
+    click.echo('Writing to file...', nl=False)
+
+    with metrics.stage('osm_schema'):
+        st_crossings, sw_links = osm_schema(st_crossings, opensidewalks)
+
+    with metrics.stage('write') as stage:
+        if sw_links is not None:
+            io.write_sidewalk_links(sw_links, links_path(outfile))
+        io.write_crossings(st_crossings, outfile)
+        stage['items'] = len(st_crossings)
+
+    click.echo('Done')
+
+
+def core_tiled(read_tile, bounds, outfile, tile_size, overlap,
+               opensidewalks=False, metrics=None, **options):
+    # Process the area one overlapping tile at a time, streaming crossings
+    # to the output, so that memory use depends on the tile size rather than
+    # on the size of the whole dataset.
+    import numpy as np
+
+    from . import io, projection, tiles
+    from .api import osm_schema
+
+    all_tiles = tiles.make_tiles(bounds, tile_size, overlap)
+    if metrics is None:
+        metrics = Metrics()
+
+    crossings_writer = io.open_writer(outfile)
+    if opensidewalks:
+        links_writer = io.open_writer(links_path(outfile))
+    else:
+        links_writer = None
+
+    # Crossings near the edge of a tile may also be drawn from a neighboring
+    # tile: remember those to skip duplicates
+    seen = set()
+    try:
+        for i, (core_bounds, query_bounds) in enumerate(all_tiles):
+            click.echo('Tile {} of {}'.format(i + 1, len(all_tiles)))
+
+            with metrics.stage('read_sidewalks') as stage:
+                sidewalks = read_tile(*query_bounds)
+                stage['items'] = len(sidewalks)
+            if sidewalks.empty:
+                continue
+
+            st_crossings = draw_crossings(sidewalks,
+                                          street_bounds=query_bounds,
+                                          ixn_bounds=core_bounds,
+                                          metrics=metrics, **options)
+            if st_crossings is None:
+                continue
+
+            wgs84 = projection.project_frame(st_crossings,
+                                             projection.WGS84)
+            keys = tiles.crossing_keys(wgs84.geometry)
+            is_new = np.array([key not in seen for key in keys], dtype=bool)
+            interior = tiles.shrink(core_bounds, tiles.BORDER_MARGIN)
+            for key, geom in zip(keys[is_new], wgs84.geometry[is_new]):
+                if not tiles.within(geom, interior):
+                    seen.add(key)
+            if opensidewalks:
+                # Links are made in UTM, then written in WGS84
+                st_crossings = st_crossings[is_new]
+            else:
+                # Crossings are written as they are: don't reproject them
+                # again
+                st_crossings = wgs84[is_new]
+
+            with metrics.stage('osm_schema'):
+                st_crossings, sw_links = osm_schema(st_crossings,
+                                                    opensidewalks)
+            with metrics.stage('write') as stage:
+                crossings_writer.write(st_crossings)
+                if links_writer is not None:
+                    links_writer.write(sw_links)
+                stage['items'] = len(st_crossings)
+    except BaseException:
+        crossings_writer.abort()
+        if links_writer is not None:
+            links_writer.abort()
+        raise
+
+    crossings_writer.close()
+    if links_writer is not None:
+        links_writer.close()
+
+    click.echo('Wrote {} crossings'.format(crossings_writer.count))
+
+
+def draw_crossings(sidewalks, street_bounds=None, ixn_bounds=None,
+                   state_path=None, G_streets=None,
+                   street_cache_size=None, cluster_radius=0, metrics=None,
+                   **options):
+    import numpy as np
+
+    from . import (cache, crossings, incremental, intersections, projection,
+                   store)
+
+    if metrics is None:
+        metrics = Metrics()
+    if street_cache_size is None:
+        street_cache_size = cache.MAX_SIZE
+
+    if isinstance(sidewalks, store.Sidewalks):
+        # Prepared sidewalks are already projected and indexed
+        sidewalks_u = sidewalks
+        utm = sidewalks.crs
+    else:
+        # Work in the UTM zone of the sidewalks, picked from their bounds.
+        # Streets are projected to the same coordinate system.
+        extent = projection.lonlat_bounds(sidewalks.total_bounds,
+                                          sidewalks.crs)
+        utm = projection.utm_crs_for_bounds(extent)
+
+        # Implied default value of 'layer' is 0, but it might be explicitly
+        # described in some cases. Don't want to accidentally compare 'nan'
+        # to 0 and get 'False' when those are implicitly true in OSM, so
+        # layers are standardized when indexing. Coordinates are projected
+        # while indexing too, in one pass.
+        with metrics.stage('index_sidewalks'):
+            sidewalks_u = store.from_frame(sidewalks, to_crs=utm,
+                                           extent=extent)
+
+    if street_bounds is None:
+        street_bounds = sidewalks_u.extent
+
+    # Street data fetched from OpenStreetMap for the same area can be reused
+    # from the street cache
+    if G_streets is None and street_cache_size:
+        key = cache.cache_key(street_bounds, USEFUL_TAGS_PATH)
+        with metrics.stage('load_street_cache'):
+            cached = cache.load_streets(key, sidewalks_u.crs)
+    else:
+        key = None
+        cached = None
+
+    if cached is None:
+        ixns, lon, lat = prepare_streets(sidewalks, utm, street_bounds,
+                                         G_streets, metrics)
+        if key is not None:
+            with metrics.stage('save_street_cache'):
+                cache.save_streets(key, sidewalks_u.crs, ixns, lon, lat,
+                                   max_size=street_cache_size)
+    else:
+        click.echo('Using cached street network')
+        ixns, lon, lat = cached
+        metrics.counters['street_cache_hits'] += 1
+
+    if cluster_radius:
+        # The nodes of a complex intersection are searched together, and the
+        # connectors between them aren't crossed
+        with metrics.stage('cluster_intersections') as stage:
+            labels = intersections.cluster_intersections(ixns,
+                                                         cluster_radius)
+            _, first = np.unique(labels, return_index=True)
+            n_streets = len(ixns.street_edge)
+            ixns = intersections.merge(ixns, labels)
+            lon = lon[first]
+            lat = lat[first]
+            stage['items'] = len(ixns.nodes)
+        metrics.counters['connectors_skipped'] += (n_streets -
+                                                   len(ixns.street_edge))
+
+    if ixn_bounds is not None:
+        # Only keep the intersections this area is responsible for (lon-lat
+        # bounds)
+        west, south, east, north = ixn_bounds
+        ixns = intersections.select(ixns, (west <= lon) & (lon < east) &
+                                    (south <= lat) & (lat < north))
+
+    #
+    # Draw crossings using the intersection + street + sidewalk info
+    #
+    click.echo('Drawing crossings...', nl=False)
+
+    if state_path is not None:
+        state = incremental.load_state(state_path, sidewalks_u.crs)
+    else:
+        state = None
+
+    with metrics.stage('make_crossings') as stage:
+        candidate_counts = []
+        st_crossings = crossings.make_crossings(
+            ixns, sidewalks_u, state=state, stats=metrics.counters,
+            candidate_counts=candidate_counts, as_frame=False, **options)
+        stage['items'] = len(st_crossings)
+    metrics.observe('candidates_evaluated_per_intersection', candidate_counts)
+
+    if state is not None:
+        incremental.save_state(state, state_path)
+
+    if not len(st_crossings):
+        return None
+
+    # Only the columns that are written
+    st_crossings = st_crossings.to_frame(sidewalks_u.crs, columns=['layer'])
+
+    click.echo('Done')
+
+    return st_crossings
+
+
+def prepare_streets(sidewalks, to_crs, street_bounds=None, G_streets=None,
+                    metrics=None):
+    # Fetch (unless given) and project the street network, and group it into
+    # intersections. Returns the intersections and the lon-lat coordinates of
+    # their nodes.
+    import numpy as np
+
+    from . import intersections, io, projection
+
+    if metrics is None:
+        metrics = Metrics()
+
+    # Streets are fetched in lon-lat, then projected once, to to_crs (the
+    # UTM zone picked from the bounds of the sidewalks)
+    if G_streets is None:
+        click.echo('Fetching street network from OpenStreetMap...', nl=False)
+
+        configure_osmnx()
+
+        with metrics.stage('fetch_streets') as stage:
+            G_streets = io.fetch_street_graph(sidewalks,
+                                              bounds=street_bounds)
+            stage['items'] = G_streets.number_of_edges()
+
+        click.echo('Done')
+
+    # Extract street graph
+    click.echo('Generating street graph...', nl=False)
+
+    with metrics.stage('project_streets'):
+        # Layers are standardized when grouping intersections
+        G_streets_u = projection.project_graph(G_streets, to_crs)
+
+    click.echo('Done')
+
+    #
+    # Isolate intersections that need crossings (degree > 3), group with
+    # their streets (all pointing out from the intersection)
+    #
+    click.echo('Isolating street intersections...', nl=False)
+
+    with metrics.stage('group_intersections') as stage:
+        ixns = intersections.group_intersections(G_streets_u)
+        lon = np.array([G_streets.nodes[n]['x'] for n in ixns.nodes],
+                       dtype=float)
+        lat = np.array([G_streets.nodes[n]['y'] for n in ixns.nodes],
+                       dtype=float)
+        stage['items'] = len(ixns.nodes)
+
+    click.echo('Done')
+
+    return ixns, lon, lat
+
+
+def links_path(outfile):
+    base, ext = path.splitext(outfile)
+    return '{}_links{}'.format(base, ext)
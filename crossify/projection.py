@@ -0,0 +1,228 @@
+'''Projection of datasets into a local UTM coordinate system, in which
+crossings are drawn.
+
+Coordinates are transformed as flat arrays, in one call per dataset, by
+transformers that are created once per pair of coordinate systems and
+cached.'''
+from functools import lru_cache
+import math
+
+import geopandas as gpd
+import numpy as np
+
+from . import geometry
+
+WGS84 = {'init': 'epsg:4326'}
+
+# Number of points along each edge of a bounding box that are transformed to
+# find its extent in another coordinate system
+BOUNDS_POINTS = 21
+
+
+def utm_crs(lon, lat):
+    '''The UTM zone coordinate system containing a lon-lat location.
+
+    :param lon: Longitude.
+    :type lon: float
+    :param lat: Latitude.
+    :type lat: float
+    :returns: The coordinate system.
+    :rtype: dict
+
+    '''
+    zone = int(math.floor((lon + 180) / 6)) % 60 + 1
+    if lat >= 0:
+        return {'init': 'epsg:{}'.format(32600 + zone)}
+    return {'init': 'epsg:{}'.format(32700 + zone)}
+
+
+def utm_crs_for(gdf):
+    # The UTM zone of the center of a dataset
+    return utm_crs_for_bounds(lonlat_bounds(gdf.total_bounds, gdf.crs))
+
+
+def utm_crs_for_bounds(bounds):
+    # The UTM zone of the center of a lon-lat bounding box
+    west, south, east, north = bounds
+    return utm_crs((west + east) / 2, (south + north) / 2)
+
+
+def crs_name(crs):
+    '''A hashable name for a coordinate system, the same for equivalent
+    descriptions of it: 'epsg:<code>' when it has an EPSG code. Datasets
+    without a coordinate system are assumed to be lon-lat.
+
+    :param crs: The coordinate system: a dict like {'init': 'epsg:4326'}, a
+                string or a pyproj CRS (newer versions of geopandas).
+    :returns: The name.
+    :rtype: str
+
+    '''
+    if not crs:
+        crs = WGS84
+    if isinstance(crs, dict):
+        if list(crs) == ['init']:
+            return crs['init'].lower()
+        return ' '.join('+{}={}'.format(k, v)
+                        for k, v in sorted(crs.items()))
+    if hasattr(crs, 'to_epsg') and crs.to_epsg() is not None:
+        return 'epsg:{}'.format(crs.to_epsg())
+    name = str(crs)
+    if name.lower().startswith('epsg:'):
+        return name.lower()
+    return name
+
+
+def same_crs(a, b):
+    return crs_name(a) == crs_name(b)
+
+
+def transformer(from_crs, to_crs):
+    '''A function that transforms arrays of x and y coordinates between two
+    coordinate systems. Transformers are cached, so they're only created once
+    per pair.
+
+    :param from_crs: The coordinate system of the coordinates.
+    :param to_crs: The coordinate system to transform them to.
+    :returns: A function of (x, y) arrays that returns (x, y) arrays.
+    :rtype: callable
+
+    '''
+    return _transformer(crs_name(from_crs), crs_name(to_crs))
+
+
+@lru_cache(maxsize=None)
+def _transformer(from_name, to_name):
+    import pyproj
+
+    if hasattr(pyproj, 'Transformer'):
+        return pyproj.Transformer.from_crs(from_name, to_name,
+                                           always_xy=True).transform
+
+    # Older versions of pyproj, used by older versions of geopandas
+    def proj(name):
+        if name.startswith('epsg:'):
+            return pyproj.Proj(init=name)
+        return pyproj.Proj(name)
+
+    from_proj = proj(from_name)
+    to_proj = proj(to_name)
+
+    def transform(x, y):
+        return pyproj.transform(from_proj, to_proj, x, y)
+
+    return transform
+
+
+def project_coords(coords, from_crs, to_crs):
+    '''Transform a (N, 2) array of coordinates.
+
+    :returns: The transformed coordinates, or the same array if the coordinate
+              systems are the same.
+    :rtype: numpy.ndarray
+
+    '''
+    if same_crs(from_crs, to_crs) or not len(coords):
+        return coords
+    x, y = transformer(from_crs, to_crs)(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+
+
+def lonlat_bounds(bounds, crs):
+    '''The lon-lat bounding box of a bounding box in another coordinate
+    system. Points along its edges are transformed, rather than only its
+    corners, as its edges may be curved in lon-lat.
+
+    :param bounds: The (minx, miny, maxx, maxy) bounding box.
+    :type bounds: list of float
+    :param crs: The coordinate system of the bounding box.
+    :returns: The (west, south, east, north) bounding box.
+    :rtype: list of float
+
+    '''
+    minx, miny, maxx, maxy = [float(x) for x in bounds]
+    if same_crs(crs, WGS84):
+        return [minx, miny, maxx, maxy]
+
+    t = np.linspace(0, 1, BOUNDS_POINTS)
+    xs = minx + (maxx - minx) * t
+    ys = miny + (maxy - miny) * t
+    edges = np.concatenate([
+        np.column_stack([xs, np.full_like(t, miny)]),
+        np.column_stack([xs, np.full_like(t, maxy)]),
+        np.column_stack([np.full_like(t, minx), ys]),
+        np.column_stack([np.full_like(t, maxx), ys])
+    ])
+    lon, lat = project_coords(edges, crs, WGS84).T
+
+    return [float(lon.min()), float(lat.min()), float(lon.max()),
+            float(lat.max())]
+
+
+def project_lines(geometries, from_crs, to_crs):
+    # Transform LineStrings, all of their coordinates at once
+    coords, offsets = geometry.line_arrays(geometries)
+    coords = project_coords(coords, from_crs, to_crs)
+    return geometry.lines_from_arrays(coords, offsets)
+
+
+def project_frame(gdf, to_crs):
+    '''Project a GeoDataFrame of LineStrings, such as crossings or links.
+
+    :param gdf: The LineStrings.
+    :type gdf: geopandas.GeoDataFrame
+    :param to_crs: The coordinate system to project to.
+    :type to_crs: dict
+    :returns: A projected copy, or the same frame if it's already in that
+              coordinate system.
+    :rtype: geopandas.GeoDataFrame
+
+    '''
+    if same_crs(gdf.crs, to_crs):
+        return gdf
+
+    projected = gdf.copy()
+    projected['geometry'] = project_lines(gdf.geometry, gdf.crs, to_crs)
+    projected = gpd.GeoDataFrame(projected)
+    if hasattr(projected, 'set_crs'):
+        # Newer versions of geopandas warn when crs is assigned over another
+        projected = projected.set_crs(to_crs, allow_override=True)
+    else:
+        projected.crs = to_crs
+
+    return projected
+
+
+def project_graph(G, to_crs):
+    '''Project a street graph, such as one made by osmnx, whose 'crs' graph
+    attribute describes the coordinates of its nodes (x, y) and edge
+    geometries. Nodes and edges without a 'crs' are assumed to be lon-lat.
+
+    :param G: The street graph.
+    :type G: networkx.MultiDiGraph
+    :param to_crs: The coordinate system to project to.
+    :type to_crs: dict
+    :returns: A projected copy of the graph.
+    :rtype: networkx.MultiDiGraph
+
+    '''
+    from_crs = G.graph.get('crs', WGS84)
+    G_u = G.copy()
+    G_u.graph['crs'] = to_crs
+
+    nodes = list(G_u.nodes)
+    coords = np.array([(G_u.nodes[n]['x'], G_u.nodes[n]['y'])
+                       for n in nodes], dtype=float).reshape(-1, 2)
+    coords = project_coords(coords, from_crs, to_crs)
+    for n, (x, y) in zip(nodes, coords.tolist()):
+        G_u.nodes[n]['x'] = x
+        G_u.nodes[n]['y'] = y
+
+    edges = [(u, v, k) for u, v, k, geom
+             in G_u.edges(keys=True, data='geometry') if geom is not None]
+    lines = project_lines([G_u.edges[edge]['geometry'] for edge in edges],
+                          from_crs, to_crs)
+    for edge, line in zip(edges, lines):
+        G_u.edges[edge]['geometry'] = line
+
+    return G_u
@@ -0,0 +1,306 @@
+'''Sidewalks stored as flat arrays, which crossings are drawn from: projected
+coordinates, standardized layers and a grid spatial index.
+
+A prepared dataset (see the prepare command) is this store written to a
+directory of .npy files, once. Opening it memory-maps the arrays, so runs
+over the same sidewalks skip reading, validating, projecting and indexing
+them, and worker processes share its pages instead of each holding a copy.'''
+from collections import namedtuple
+import json
+import os
+import shutil
+from tempfile import mkdtemp
+
+import numpy as np
+from shapely.geometry import LineString
+
+from . import __version__, geometry, projection, validators
+
+# Bump when the layout of prepared datasets changes
+FORMAT_VERSION = 1
+
+# Size of the grid index cells, in meters. Queries cover a street and a
+# corridor on one side of it, so they span a few cells.
+CELL_SIZE = 50.0
+
+META_FILE = 'meta.json'
+
+# The coordinates of sidewalk i are coords[offsets[i]:offsets[i + 1]]. ids
+# are the labels of the sidewalks in the original dataset and boxes their
+# (minx, miny, maxx, maxy) bounds.
+#
+# The grid index lists the sidewalks whose bounds overlap each non-empty
+# cell: those of cells[j] are cell_items[cell_offsets[j]:cell_offsets[j + 1]].
+# extent is the lon-lat (west, south, east, north) bounding box of the
+# dataset.
+Sidewalks = namedtuple('Sidewalks', [
+    'coords',
+    'offsets',
+    'layer',
+    'ids',
+    'boxes',
+    'cells',
+    'cell_offsets',
+    'cell_items',
+    'cell_size',
+    'crs',
+    'extent'
+])
+
+ARRAYS = ['coords', 'offsets', 'layer', 'ids', 'boxes', 'cells',
+          'cell_offsets', 'cell_items']
+
+
+def from_frame(sidewalks, to_crs=None, extent=None, cell_size=CELL_SIZE):
+    '''Store sidewalks as arrays and index them.
+
+    :param sidewalks: Sidewalk LineStrings, with an optional 'layer' column.
+    :type sidewalks: geopandas.GeoDataFrame
+    :param to_crs: The projected, meter-based coordinate system to store the
+                   sidewalks in. Their coordinates are transformed once, as
+                   an array. If not given, they must already be in one.
+    :type to_crs: dict
+    :param extent: The lon-lat bounding box of the sidewalks. Found from
+                   their bounds if not given.
+    :type extent: list of float
+    :param cell_size: Size of the grid index cells.
+    :type cell_size: float
+    :returns: The stored sidewalks.
+    :rtype: Sidewalks
+
+    '''
+    coords, offsets = geometry.line_arrays(sidewalks.geometry)
+
+    if extent is None:
+        if len(sidewalks) and sidewalks.crs:
+            extent = projection.lonlat_bounds(sidewalks.total_bounds,
+                                              sidewalks.crs)
+        else:
+            extent = sidewalks.total_bounds
+    extent = [float(x) for x in extent]
+
+    if to_crs is None:
+        crs = sidewalks.crs
+    else:
+        coords = projection.project_coords(coords, sidewalks.crs, to_crs)
+        crs = to_crs
+
+    if 'layer' in sidewalks.columns:
+        layer = validators.layer_values(sidewalks['layer'])
+    else:
+        layer = np.zeros(len(sidewalks), dtype=int)
+
+    boxes = line_boxes(coords, offsets)
+    cells, cell_offsets, cell_items = grid_index(boxes, cell_size)
+
+    return Sidewalks(
+        coords=coords,
+        offsets=offsets,
+        layer=layer,
+        ids=np.asarray(sidewalks.index.values),
+        boxes=boxes,
+        cells=cells,
+        cell_offsets=cell_offsets,
+        cell_items=cell_items,
+        cell_size=float(cell_size),
+        crs=crs,
+        extent=extent
+    )
+
+
+def line_boxes(coords, offsets):
+    # Bounds of every line, with reduceat over the first coordinate of each
+    if len(offsets) < 2:
+        return np.empty((0, 4))
+    starts = offsets[:-1]
+    return np.column_stack([np.minimum.reduceat(coords[:, 0], starts),
+                            np.minimum.reduceat(coords[:, 1], starts),
+                            np.maximum.reduceat(coords[:, 0], starts),
+                            np.maximum.reduceat(coords[:, 1], starts)])
+
+
+def grid_index(boxes, cell_size):
+    '''Index boxes in a grid: every box is listed under each cell it overlaps.
+
+    :param boxes: (N, 4) array of (minx, miny, maxx, maxy) bounds.
+    :type boxes: numpy.ndarray
+    :param cell_size: Width and height of the cells.
+    :type cell_size: float
+    :returns: Sorted keys of the non-empty cells (see cell_keys), offsets
+              into the list of boxes of each cell, and that list.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    low = np.floor(boxes[:, :2] / cell_size).astype(np.int64)
+    high = np.floor(boxes[:, 2:] / cell_size).astype(np.int64)
+    width = high[:, 0] - low[:, 0] + 1
+    counts = width * (high[:, 1] - low[:, 1] + 1)
+
+    # One row per (box, cell) pair
+    items = np.repeat(np.arange(len(boxes)), counts)
+    starts = np.zeros(len(boxes), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    k = np.arange(len(items)) - np.repeat(starts, counts)
+    cx = low[items, 0] + k % width[items]
+    cy = low[items, 1] + k // width[items]
+
+    keys = cell_keys(cx, cy)
+    order = np.argsort(keys, kind='stable')
+    cells, first = np.unique(keys[order], return_index=True)
+    cell_offsets = np.append(first, len(items)).astype(np.intp)
+
+    return cells, cell_offsets, items[order].astype(np.intp)
+
+
+def cell_keys(cx, cy):
+    # Cell coordinates combined into one integer
+    return (np.asarray(cx, dtype=np.int64) * 2 ** 32 +
+            np.asarray(cy, dtype=np.int64))
+
+
+def query(sidewalks, bounds):
+    '''Find the sidewalks whose bounds intersect a bounding box.
+
+    :param sidewalks: The sidewalks.
+    :type sidewalks: Sidewalks
+    :param bounds: The (minx, miny, maxx, maxy) bounding box.
+    :type bounds: tuple of float
+    :returns: Positions of the sidewalks, in order.
+    :rtype: numpy.ndarray of int
+
+    '''
+    minx, miny, maxx, maxy = bounds
+    size = sidewalks.cell_size
+    cx = np.arange(np.floor(minx / size), np.floor(maxx / size) + 1)
+    cy = np.arange(np.floor(miny / size), np.floor(maxy / size) + 1)
+    keys = cell_keys(np.repeat(cx, len(cy)), np.tile(cy, len(cx)))
+
+    cells = sidewalks.cells
+    found = np.searchsorted(cells, keys)
+    inside = found < len(cells)
+    found = found[inside]
+    found = found[cells[found] == keys[inside]]
+    if not len(found):
+        return np.empty(0, dtype=np.intp)
+
+    starts = sidewalks.cell_offsets[found]
+    lengths = sidewalks.cell_offsets[found + 1] - starts
+    positions = (np.arange(lengths.sum()) -
+                 np.repeat(np.cumsum(lengths) - lengths, lengths) +
+                 np.repeat(starts, lengths))
+    candidates = np.unique(sidewalks.cell_items[positions])
+
+    # Cells are coarse: check the bounds themselves
+    boxes = sidewalks.boxes[candidates]
+    hits = ((boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx) &
+            (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny))
+
+    return candidates[hits]
+
+
+def line_coords(sidewalks, i):
+    return sidewalks.coords[sidewalks.offsets[i]:sidewalks.offsets[i + 1]]
+
+
+def line(sidewalks, i):
+    return LineString(line_coords(sidewalks, i))
+
+
+def lines(sidewalks, positions):
+    '''Gather the coordinates of some sidewalks.
+
+    :param sidewalks: The sidewalks.
+    :type sidewalks: Sidewalks
+    :param positions: Positions of the sidewalks to gather.
+    :type positions: numpy.ndarray of int
+    :returns: Their coordinates and offsets, as from geometry.line_arrays.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    starts = sidewalks.offsets[positions]
+    lengths = sidewalks.offsets[positions + 1] - starts
+    offsets = np.zeros(len(positions) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=offsets[1:])
+    shift = starts - offsets[:-1]
+    coords = sidewalks.coords[np.arange(offsets[-1]) +
+                              np.repeat(shift, lengths)]
+
+    return coords, offsets
+
+
+def is_prepared(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+def write(sidewalks, path):
+    '''Write a prepared dataset.
+
+    :param sidewalks: The sidewalks.
+    :type sidewalks: Sidewalks
+    :param path: Directory to write. If it exists, it must be a prepared
+                 dataset, which is replaced.
+    :type path: str
+
+    '''
+    if os.path.exists(path) and not is_prepared(path):
+        raise ValueError('{} exists and isn\'t a prepared dataset'.format(
+            path))
+
+    ids = sidewalks.ids
+    if ids.dtype.kind not in 'iu':
+        # Only integer labels can be memory-mapped: use positions instead
+        ids = np.arange(len(ids))
+
+    crs = sidewalks.crs
+    if not isinstance(crs, dict):
+        # Newer versions of geopandas use pyproj CRS objects
+        crs = str(crs)
+
+    meta = {
+        'format': FORMAT_VERSION,
+        'version': __version__,
+        'count': len(ids),
+        'cell_size': sidewalks.cell_size,
+        'crs': crs,
+        'extent': sidewalks.extent
+    }
+
+    # Create a temporary directory and attempt to write the dataset
+    tempdir = mkdtemp()
+    try:
+        for name in ARRAYS:
+            array = ids if name == 'ids' else getattr(sidewalks, name)
+            np.save(os.path.join(tempdir, name + '.npy'),
+                    np.ascontiguousarray(array))
+        with open(os.path.join(tempdir, META_FILE), 'w') as f:
+            json.dump(meta, f)
+    except Exception as e:
+        shutil.rmtree(tempdir)
+        raise e
+
+    # Writing was successful, so move the dataset to the correct path
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    shutil.move(tempdir, path)
+
+
+def open_prepared(path):
+    '''Open a prepared dataset, memory-mapping its arrays.
+
+    :param path: Directory of the prepared dataset.
+    :type path: str
+    :returns: The sidewalks.
+    :rtype: Sidewalks
+
+    '''
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT_VERSION:
+        raise ValueError('{} was prepared by an incompatible version of '
+                         'crossify: prepare it again'.format(path))
+
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+              for name in ARRAYS}
+
+    return Sidewalks(cell_size=meta['cell_size'], crs=meta['crs'],
+                     extent=meta['extent'], **arrays)
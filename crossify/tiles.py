@@ -0,0 +1,102 @@
+'''Functions for splitting large areas into overlapping tiles.'''
+import math
+
+import numpy as np
+
+# Approximate length of one degree of latitude, in meters
+METERS_PER_DEGREE = 111320
+
+# Crossings within this distance (meters) of a tile's edge could also be drawn
+# from the intersections of a neighboring tile
+BORDER_MARGIN = 100
+
+
+def degrees(meters, lat):
+    '''Approximate a distance in meters as degrees of longitude and latitude
+    at a given latitude.'''
+    dlat = meters / METERS_PER_DEGREE
+    coslat = max(math.cos(math.radians(lat)), 1e-6)
+    dlon = meters / (METERS_PER_DEGREE * coslat)
+
+    return dlon, dlat
+
+
+def make_tiles(bounds, size, overlap):
+    '''Split a lon-lat bounding box into tiles.
+
+    Every tile has a core area and a larger query area that includes
+    `overlap` meters around the core. The cores cover the bounding box
+    without overlapping, so every location belongs to exactly one tile. The
+    cores of tiles on the edge of the bounding box extend out to their query
+    area, so nothing fetched for a tile is left without an owner.
+
+    :param bounds: The (west, south, east, north) bounding box.
+    :type bounds: list of float
+    :param size: The width and height of each tile core, in meters.
+    :type size: float
+    :param overlap: Size of the margin around each core, in meters.
+    :type overlap: float
+    :returns: (core, query) bounding box pairs.
+    :rtype: list of tuple
+
+    '''
+    west, south, east, north = bounds
+
+    _, dlat = degrees(size, 0)
+    n_rows = max(1, int(math.ceil((north - south) / dlat)))
+    row_edges = np.linspace(south, north, n_rows + 1)
+
+    result = []
+    for row in range(n_rows):
+        row_south = row_edges[row]
+        row_north = row_edges[row + 1]
+        # Use the latitude furthest from the equator, so that tiles are never
+        # larger than requested
+        lat = max(abs(row_south), abs(row_north))
+        dlon, _ = degrees(size, lat)
+        n_cols = max(1, int(math.ceil((east - west) / dlon)))
+        col_edges = np.linspace(west, east, n_cols + 1)
+        pad_lon, pad_lat = degrees(overlap, lat)
+
+        for col in range(n_cols):
+            core = [col_edges[col], row_south, col_edges[col + 1], row_north]
+            query = (core[0] - pad_lon, core[1] - pad_lat,
+                     core[2] + pad_lon, core[3] + pad_lat)
+            if col == 0:
+                core[0] = query[0]
+            if col == n_cols - 1:
+                core[2] = query[2]
+            if row == 0:
+                core[1] = query[1]
+            if row == n_rows - 1:
+                core[3] = query[3]
+            result.append((tuple(core), query))
+
+    return result
+
+
+def shrink(bounds, meters):
+    # Shrink a lon-lat bounding box by a distance in meters on every side
+    west, south, east, north = bounds
+    lat = max(abs(south), abs(north))
+    dlon, dlat = degrees(meters, lat)
+
+    return (west + dlon, south + dlat, east - dlon, north - dlat)
+
+
+def within(geom, bounds):
+    west, south, east, north = bounds
+    minx, miny, maxx, maxy = geom.bounds
+
+    return minx >= west and miny >= south and maxx <= east and maxy <= north
+
+
+def crossing_keys(geometries, decimals=7):
+    '''Direction-independent keys for lon-lat crossing lines, based on their
+    rounded endpoints.'''
+    keys = np.empty(len(geometries), dtype=object)
+    for i, geom in enumerate(geometries):
+        coords = np.round(np.asarray(geom.coords)[[0, -1], :2], decimals)
+        keys[i] = tuple(sorted(map(tuple, coords)))
+
+    return keys
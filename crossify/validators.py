@@ -1,5 +1,6 @@
 '''Functions for validating and sprucing-up inputs.'''
 import numpy as np
+import pandas as pd
 
 
 def validate_sidewalks(sidewalks):
@@ -28,24 +29,49 @@ def validate_streets(streets):
                         ' MultiLineStrings?')
 
 
-def transform_layer(layer):
-    # Convert nans to 0
-    if layer is np.nan:
-        return 0
+def layer_values(layers):
+    '''Standardize OSM 'layer' values: missing and invalid values are layer
+    0, and the first of several values (a list or a ';'-separated string) is
+    used.
 
+    :param layers: The layer values.
+    :type layers: pandas.Series or list
+    :returns: Integer layers.
+    :rtype: numpy.ndarray of int
+
+    '''
+    if not isinstance(layers, pd.Series):
+        layers = pd.Series(list(layers), dtype=object)
+
+    if layers.dtype.kind in 'iu':
+        return layers.values.astype(int)
+
+    if layers.dtype.kind in 'bf':
+        return _layer_numbers(layers)
+
+    # There are only a few distinct layers: standardize each of them once
     try:
-        return int(layer)
-    except ValueError:
-        # Value can't be represented as integer - invalid schema, just
-        # assume default layer
-        return 0
+        codes, uniques = pd.factorize(layers)
     except TypeError:
-        # Sometimes it's a list and that's annoying
-        return int(layer[0])
+        # Lists aren't hashable
+        codes = np.arange(len(layers))
+        uniques = layers.values
+    numbers = _layer_numbers(pd.Series(uniques, dtype=object))
 
+    # Missing values have code -1: the appended 0
+    return np.append(numbers, 0)[codes]
 
-def standardize_layer(gdf):
-    if 'layer' in gdf.columns:
-        gdf['layer'] = gdf['layer'].apply(transform_layer)
-    else:
-        gdf['layer'] = 0
+
+def _layer_numbers(layers):
+    numbers = pd.to_numeric(layers, errors='coerce')
+
+    # Only lists and strings with several values are left for a second pass
+    multiple = numbers.isnull() & layers.notnull()
+    if multiple.any():
+        values = layers[multiple]
+        first = values.str.split(';').str[0].fillna(values.str[0])
+        numbers[multiple] = pd.to_numeric(first, errors='coerce')
+
+    numbers = numbers.where(np.isfinite(numbers), 0)
+
+    return numbers.values.astype(int)
@@ -34,6 +34,8 @@ config = {
                          'osmnx',
                          'overpass',
                          'Shapely'],
+    'extras_require': {'extract': ['osmium'],
+                       'parquet': ['pyarrow']},
     'packages': find_packages(),
     'include_package_data': True,
     'classifiers': ['Programming Language :: Python',
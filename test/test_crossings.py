@@ -0,0 +1,357 @@
+'''Regression tests of the crossings drawn on a synthetic city: a skewed
+grid with divided roads, whose expected crossings are in
+data/synthetic_crossings.json.'''
+import json
+import os
+
+import numpy as np
+import pytest
+
+from crossify import benchmark, crossings, intersections
+
+DATA = os.path.join(os.path.dirname(__file__), 'data',
+                    'synthetic_crossings.json')
+
+# Parameters of the synthetic city
+CITY = {'size': 100, 'skew': 0.2, 'divided': 3}
+
+
+def crossing_set(st_crossings):
+    # Crossings as sorted, direction-independent endpoint rows rounded to
+    # the millimeter, with their layer
+    rows = []
+    for geom, layer in zip(st_crossings.geometry, st_crossings['layer']):
+        coords = np.round(np.asarray(geom.coords)[[0, -1], :2], 3).tolist()
+        rows.append(sorted(coords) + [int(layer)])
+    return sorted(rows)
+
+
+def draw(**options):
+    G, sidewalks = benchmark.synthetic_city(**CITY)
+    ixns = intersections.group_intersections(G)
+    return crossings.make_crossings(ixns, sidewalks, **options)
+
+
+def test_exact_crossings():
+    with open(DATA) as f:
+        expected = json.load(f)
+    assert crossing_set(draw()) == expected
+
+
+def test_bounded_search_matches_exhaustive():
+    exhaustive = draw(search='exhaustive')
+    bounded = draw(search='bounded')
+    assert [g.wkt for g in bounded.geometry] == [g.wkt for g in
+                                                 exhaustive.geometry]
+
+
+def test_workers_match_serial():
+    serial = draw(workers=1)
+    parallel = draw(workers=3)
+    assert [g.wkt for g in parallel.geometry] == [g.wkt for g in
+                                                  serial.geometry]
+    assert list(parallel['sw_left']) == list(serial['sw_left'])
+    assert list(parallel['sw_right']) == list(serial['sw_right'])
+
+
+def test_prepared_store_matches_frame(tmpdir):
+    # A prepared store, reopened memory-mapped, gives the same sidewalk
+    # queries and crossings as indexing the frame in memory
+    from crossify import store
+
+    G, sidewalks = benchmark.synthetic_city(**CITY)
+    ixns = intersections.group_intersections(G)
+    in_memory = store.from_frame(sidewalks, cell_size=30)
+
+    path = str(tmpdir.join('sidewalks.prepared'))
+    store.write(in_memory, path)
+    assert store.is_prepared(path)
+    prepared = store.open_prepared(path)
+    assert isinstance(prepared.coords, np.memmap)
+    for name in store.ARRAYS:
+        assert np.array_equal(getattr(prepared, name),
+                              getattr(in_memory, name))
+
+    # The grid index finds exactly the sidewalks whose bounds intersect a
+    # box
+    boxes = np.asarray(prepared.boxes)
+    for minx, miny in [(0, 0), (140, 260), (333, 97)]:
+        bounds = (minx, miny, minx + 75, miny + 40)
+        expected = np.flatnonzero((boxes[:, 0] <= bounds[2]) &
+                                  (boxes[:, 2] >= bounds[0]) &
+                                  (boxes[:, 1] <= bounds[3]) &
+                                  (boxes[:, 3] >= bounds[1]))
+        assert store.query(prepared, bounds).tolist() == expected.tolist()
+
+    expected = crossings.make_crossings(ixns, sidewalks)
+    result = crossings.make_crossings(ixns, prepared)
+    assert [g.wkt for g in result.geometry] == [g.wkt for g in
+                                                expected.geometry]
+    assert list(result['sw_left']) == list(expected['sw_left'])
+    assert list(result['sw_right']) == list(expected['sw_right'])
+
+
+def test_crossing_buffer():
+    # Degenerate and non-finite crossings are dropped, chunks grow without
+    # losing rows, and extend and select keep the order
+    from crossify.buffer import Crossing, CrossingBuffer
+
+    def crossing(start, end, layer=0):
+        return Crossing(start, end, 0, 1, 2.0, 3.0, 0.5, layer)
+
+    buf = CrossingBuffer(chunk_size=2)
+    assert buf.append(0, crossing((0, 0), (1, 0)))
+    assert not buf.append(1, crossing((2, 2), (2, 2)))
+    assert not buf.append(2, crossing((0, np.nan), (1, 0)))
+    assert not buf.append(3, crossing((0, 0), (np.inf, 0)))
+    for i in range(4, 7):
+        assert buf.append(i, crossing((i, 0), (i, 1), layer=i))
+    assert len(buf) == 4
+
+    other = CrossingBuffer(chunk_size=3)
+    # Unknown sidewalks, as in crossings reused by an incremental run
+    other.append(7, Crossing((7, 0), (7, 1), -1, -1, np.nan, np.nan, np.nan,
+                             0))
+    buf.extend(other)
+    buf.extend(CrossingBuffer())
+    assert len(buf) == 5
+    columns = buf.columns()
+    assert columns['ixn'].tolist() == [0, 4, 5, 6, 7]
+    assert columns['coords'][1].tolist() == [4, 0, 4, 1]
+    assert columns['layer'].tolist() == [0, 4, 5, 6, 0]
+
+    buf.select(np.array([4, 3, 0]))
+    assert buf.columns()['ixn'].tolist() == [7, 6, 0]
+    sidewalk_ids = np.array([10, 11])
+    nodes = np.arange(100, 108)
+    gdf = buf.to_frame({'init': 'epsg:32610'}, sidewalk_ids, nodes)
+    assert [list(g.coords) for g in gdf.geometry] == [
+        [(7, 0), (7, 1)], [(6, 0), (6, 1)], [(0, 0), (1, 0)]]
+    assert list(gdf['ixn']) == [107, 106, 100]
+    assert gdf['sw_left'].isnull().tolist() == [True, False, False]
+    assert list(gdf['sw_left'][1:]) == [10, 10]
+    assert list(gdf['sw_right'][1:]) == [11, 11]
+
+
+def test_empty_crossing_buffer():
+    from crossify.buffer import FRAME_COLUMNS, CrossingBuffer
+
+    gdf = CrossingBuffer().to_frame({'init': 'epsg:32610'},
+                                    np.array([], dtype=int),
+                                    np.array([], dtype=int))
+    assert len(gdf) == 0
+    assert list(gdf.columns) == ['geometry'] + FRAME_COLUMNS
+
+
+def read_output(path):
+    # Geometries and layers of a GeoParquet or FlatGeobuf file
+    from shapely import wkb
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.read_table(path)
+        geo = json.loads(table.schema.metadata[b'geo'].decode())
+        assert geo['primary_column'] == 'geometry'
+        assert geo['columns']['geometry']['encoding'] == 'WKB'
+        columns = table.to_pydict()
+        return ([wkb.loads(bytes(g)) for g in columns['geometry']],
+                columns.get('layer', []))
+
+    import fiona
+    from shapely.geometry import shape
+
+    with fiona.open(path) as collection:
+        records = list(collection)
+    return ([shape(r['geometry']) for r in records],
+            [r['properties']['layer'] for r in records])
+
+
+@pytest.mark.parametrize('ext', ['.parquet', '.fgb'])
+def test_writers(tmpdir, ext):
+    # Crossings written in batches read back in WGS84 with their layers. A
+    # writer without batches writes an empty file.
+    from crossify import io, projection
+
+    if ext == '.parquet':
+        pytest.importorskip('pyarrow')
+
+    st_crossings = draw()[['geometry', 'layer']]
+    wgs84 = projection.project_frame(st_crossings, projection.WGS84)
+
+    path = str(tmpdir.join('crossings' + ext))
+    writer = io.open_writer(path)
+    half = len(st_crossings) // 2
+    writer.write(st_crossings[:half])
+    writer.write(st_crossings[half:])
+    writer.close()
+    assert writer.count == len(st_crossings)
+
+    # FlatGeobuf orders features along its spatial index, so rows are
+    # compared sorted
+    def rows(geoms, layers):
+        return sorted((tuple(np.round(np.ravel(g.coords), 9)), int(layer))
+                      for g, layer in zip(geoms, layers))
+
+    assert rows(*read_output(path)) == rows(wgs84.geometry, wgs84['layer'])
+
+    empty = str(tmpdir.join('empty' + ext))
+    io.open_writer(empty).close()
+    assert read_output(empty)[0] == []
+
+
+def test_candidate_counts():
+    # Candidates evaluated per intersection, the same with workers. Bounded
+    # search evaluates fewer.
+    from collections import Counter
+
+    counts = {}
+    for workers, search in [(1, 'exhaustive'), (3, 'exhaustive'),
+                            (1, 'bounded')]:
+        stats = Counter()
+        counts[workers, search] = []
+        draw(workers=workers, search=search, stats=stats,
+             candidate_counts=counts[workers, search])
+        assert len(counts[workers, search]) == stats['intersections']
+        assert sum(counts[workers, search]) == stats['candidates_evaluated']
+    assert counts[3, 'exhaustive'] == counts[1, 'exhaustive']
+    assert sum(counts[1, 'bounded']) < sum(counts[1, 'exhaustive'])
+
+
+def test_unique_crossings_drops_reversed_duplicates():
+    endpoints = np.array([
+        [0.0, 0.0, 10.0, 0.0],
+        [10.0, 0.0, 0.0, 0.0],       # reversed
+        [0.001, 0.0, 10.0, 0.002],   # within the snapping precision
+        [0.0, 5.0, 10.0, 5.0],
+        [10.0, 5.3, 0.2, 5.0],       # reversed, within the tolerance
+        [0.0, 0.0, 10.0, 0.0]        # exact
+    ])
+    assert crossings.unique_crossings(endpoints).tolist() == [0, 3, 4]
+    assert crossings.unique_crossings(endpoints,
+                                      tolerance=0.5).tolist() == [0, 3]
+    assert not len(crossings.unique_crossings(np.empty((0, 4))))
+
+
+def junction_graph(connected=True, layer=0):
+    # Two four-way intersections 10 m apart: A at the origin and B east of
+    # it, joined by a connector unless connected is False. B's other streets
+    # are on the given layer.
+    import networkx as nx
+
+    G = nx.MultiDiGraph()
+    positions = {'A': (0, 0), 'W': (-50, 0), 'N': (0, 50), 'S': (0, -50),
+                 'B': (10, 0), 'E': (60, 0), 'N2': (10, 50),
+                 'S2': (10, -50), 'W2': (5, 40)}
+    for node, (x, y) in positions.items():
+        G.add_node(node, x=x, y=y)
+    streets = [('A', 'W', 0), ('A', 'N', 0), ('A', 'S', 0),
+               ('B', 'E', layer), ('B', 'N2', layer), ('B', 'S2', layer)]
+    if connected:
+        streets.append(('A', 'B', 0))
+    else:
+        # B stays an intersection with a fourth street instead
+        streets.append(('B', 'W2', layer))
+    for u, v, street_layer in streets:
+        G.add_edge(u, v, layer=street_layer)
+        G.add_edge(v, u, layer=street_layer)
+    return G
+
+
+def test_cluster_and_merge():
+    ixns = intersections.group_intersections(junction_graph())
+    assert list(ixns.nodes) == ['A', 'B']
+
+    # Only intersections within the radius are clustered
+    assert list(intersections.cluster_intersections(ixns, 5)) == [0, 1]
+    labels = intersections.cluster_intersections(ixns, 15)
+    assert list(labels) == [0, 0]
+
+    # The merged intersection is at A, with the streets of A and B but not
+    # the connector between them
+    merged = intersections.merge(ixns, labels)
+    assert list(merged.nodes) == ['A']
+    assert (merged.x[0], merged.y[0]) == (0, 0)
+    ends = sorted(tuple(intersections.street_coords(merged, s)[-1])
+                  for s in intersections.streets(merged, 0))
+    assert ends == [(-50, 0), (0, -50), (0, 50), (10, -50), (10, 50),
+                    (60, 0)]
+    connector = [list(edge[:2]) for edge in merged.edges].index(['A', 'B'])
+    assert connector not in merged.street_edge
+
+    # Without clustering, merging changes nothing
+    unmerged = intersections.merge(
+        ixns, intersections.cluster_intersections(ixns, 0))
+    assert list(unmerged.offsets) == list(ixns.offsets)
+    assert np.array_equal(unmerged.street_coords, ixns.street_coords)
+
+
+def test_cluster_needs_shared_layer():
+    # Nearby intersections without a street on the same layer, such as a
+    # bridge over a junction, stay apart
+    for layer, expected in [(0, [0, 0]), (1, [0, 1])]:
+        G = junction_graph(connected=False, layer=layer)
+        ixns = intersections.group_intersections(G)
+        labels = intersections.cluster_intersections(ixns, 15)
+        assert list(labels) == expected
+
+
+def test_street_index_keeps_far_segments():
+    # A crossing's endpoints are the sidewalk points nearest to its sample
+    # point, so it can meet another street far from the intersection: the
+    # far segments of a curved street must still be obstacles
+    import networkx as nx
+    from shapely.geometry import LineString
+
+    G = nx.MultiDiGraph()
+    G.add_node(0, x=0.0, y=0.0)
+    ends = {1: (100.0, 0.0), 2: (-100.0, 0.0), 3: (0.0, 100.0)}
+    for node, (x, y) in ends.items():
+        G.add_node(node, x=x, y=y)
+        G.add_edge(0, node, geometry=LineString([(0, 0), (x, y)]))
+    G.add_node(4, x=0.0, y=-10.0)
+    curve = LineString([(0, 0), (0, -10), (80, -60), (90, -60)])
+    G.add_edge(0, 4, geometry=curve)
+
+    ixns = intersections.group_intersections(G)
+    seg_starts, seg_ends, _ = crossings.street_index(ixns, 0)
+    segments = {(tuple(a), tuple(b)) for a, b in zip(seg_starts.tolist(),
+                                                     seg_ends.tolist())}
+    assert ((80.0, -60.0), (90.0, -60.0)) in segments
+
+
+def test_incremental_rerun(tmpdir):
+    # Rerunning with a moved sidewalk only redraws the intersections near it,
+    # and gives the same crossings as drawing everything
+    from collections import Counter
+
+    from shapely.affinity import translate
+
+    from crossify import incremental
+
+    G, sidewalks = benchmark.synthetic_city(**CITY)
+    ixns = intersections.group_intersections(G)
+    path = str(tmpdir.join('state.json'))
+    state = incremental.load_state(path, sidewalks.crs)
+    crossings.make_crossings(ixns, sidewalks, state=state)
+
+    # The state is written atomically, next to its final path
+    incremental.save_state(state, path)
+    assert tmpdir.listdir() == [tmpdir.join('state.json')]
+    assert incremental.load_state(path, sidewalks.crs) == state
+
+    stats = Counter()
+    unchanged = crossings.make_crossings(ixns, sidewalks, state=state,
+                                         stats=stats)
+    assert stats['intersections'] == 0
+    assert crossing_set(unchanged) == crossing_set(draw())
+
+    label = sidewalks.index[len(sidewalks) // 2]
+    sidewalks.loc[label, 'geometry'] = translate(sidewalks.geometry[label],
+                                                 1, 1)
+    stats = Counter()
+    moved = crossings.make_crossings(ixns, sidewalks, state=state,
+                                     stats=stats)
+    assert 0 < stats['intersections'] < len(ixns.nodes) / 4
+    assert crossing_set(moved) == crossing_set(
+        crossings.make_crossings(ixns, sidewalks))
@@ -0,0 +1,213 @@
+'''Tests of concurrent fetching, against a stand-in Overpass server running
+in a thread.'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import re
+from socketserver import ThreadingMixIn
+import threading
+from urllib.error import HTTPError
+from urllib.parse import parse_qs
+
+import pytest
+
+from crossify import fetch
+
+# Bounding box fetched by the tests: about 2.2 x 1.1 km, so 3 x 2 tiles of
+# 1 km
+BOUNDS = [0.0, 0.0, 0.02, 0.01]
+TILE_SIZE = 1000
+
+# Nodes of the stand-in server: id -> (lon, lat)
+NODES = {
+    1: (0.001, 0.005),
+    2: (0.019, 0.005),
+    3: (0.001, 0.0051),
+    4: (0.009, 0.0051),
+    5: (0.011, 0.002),
+    6: (0.011, 0.008)
+}
+
+# Ways of the stand-in server. The street and the first sidewalk cross tile
+# edges, so several tiles return them.
+WAYS = [
+    {'type': 'way', 'id': 10, 'nodes': [1, 2],
+     'tags': {'highway': 'residential'}},
+    {'type': 'way', 'id': 20, 'nodes': [3, 4],
+     'tags': {'highway': 'footway', 'footway': 'sidewalk'}},
+    {'type': 'way', 'id': 21, 'nodes': [5, 6],
+     'tags': {'highway': 'footway', 'footway': 'sidewalk'}}
+]
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        # Answers to give before answering normally: an HTTP status code,
+        # 'disconnect', 'html' or 'runtime error'
+        self.failures = []
+        self.queries = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/interpreter'.format(self.server_port)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        query = parse_qs(self.rfile.read(length).decode())['data'][0]
+        with self.server.lock:
+            self.server.queries.append(query)
+            failure = (self.server.failures.pop(0)
+                       if self.server.failures else None)
+
+        if failure == 'disconnect':
+            # Close the connection without answering
+            self.close_connection = True
+            return
+        if isinstance(failure, int):
+            self.send_error(failure)
+            return
+        if failure == 'html':
+            self.answer(b'<html><body>Too many requests</body></html>')
+            return
+
+        response = {'elements': elements(query)}
+        if failure == 'runtime error':
+            response['remark'] = ('runtime error: Query timed out in "query" '
+                                  'at line 1 after 180 seconds.')
+        self.answer(json.dumps(response).encode())
+
+    def answer(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def elements(query):
+    # The ways matching a query that have a node in its bounding box, and
+    # their nodes
+    south, west, north, east = [float(x) for x in re.search(
+        r'\(([-\d.e]+),([-\d.e]+),([-\d.e]+),([-\d.e]+)\)', query).groups()]
+    sidewalks = 'sidewalk' in query
+
+    result = []
+    for way in WAYS:
+        if (way['tags'].get('footway') == 'sidewalk') != sidewalks:
+            continue
+        if any(west <= NODES[n][0] <= east and south <= NODES[n][1] <= north
+               for n in way['nodes']):
+            result.append(way)
+            result += [{'type': 'node', 'id': n, 'lon': NODES[n][0],
+                        'lat': NODES[n][1]} for n in way['nodes']]
+    return result
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(fetch, 'BACKOFF', 0)
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetch_elements(server, cache_dir=None, tile_size=TILE_SIZE,
+                   max_requests=2):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(fetch.fetch_elements(
+            BOUNDS, tile_size, server.url, max_requests, cache_dir))
+    finally:
+        loop.close()
+
+
+def fetch_query(server, cache_dir=None):
+    # Fetch the streets of the whole bounding box with a single query
+    query = fetch.overpass_query(fetch.STREETS_FILTER, BOUNDS)
+    loop = asyncio.new_event_loop()
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            return loop.run_until_complete(fetch.fetch_query(
+                query, server.url, asyncio.Semaphore(1), executor,
+                cache_dir))
+    finally:
+        loop.close()
+
+
+def ids(elements):
+    return sorted((element['type'], element['id']) for element in elements)
+
+
+def test_tiles_merged_by_id(server):
+    streets, sidewalks = fetch_elements(server)
+
+    # Streets and sidewalks of 6 tiles
+    assert len(server.queries) == 12
+    assert ids(streets) == [('node', 1), ('node', 2), ('way', 10)]
+    assert ids(sidewalks) == [('node', 3), ('node', 4), ('node', 5),
+                              ('node', 6), ('way', 20), ('way', 21)]
+
+    ways = fetch.ways_from_elements(sidewalks)
+    assert sorted((way_id, coords) for way_id, _, _, coords in ways) == [
+        (20, [NODES[3], NODES[4]]),
+        (21, [NODES[5], NODES[6]])
+    ]
+
+
+@pytest.mark.parametrize('failure', [429, 500, 502, 503, 504, 'disconnect',
+                                     'html', 'runtime error'])
+def test_retry(server, failure):
+    server.failures = [failure, failure]
+    response = fetch_query(server)
+
+    assert len(server.queries) == 3
+    assert ids(response['elements']) == [('node', 1), ('node', 2),
+                                         ('way', 10)]
+
+
+def test_no_retry_of_client_errors(server):
+    server.failures = [400]
+    with pytest.raises(HTTPError):
+        fetch_query(server)
+    assert len(server.queries) == 1
+
+
+def test_runtime_error_remark(server, monkeypatch, tmpdir):
+    # Incomplete data is never returned or cached
+    monkeypatch.setattr(fetch, 'RETRIES', 1)
+    server.failures = ['runtime error'] * 2
+    cache_dir = str(tmpdir.join('overpass'))
+    with pytest.raises(fetch.OverpassError):
+        fetch_query(server, cache_dir)
+    assert len(server.queries) == 2
+    assert not os.path.exists(cache_dir)
+
+
+def test_cache_hit(server, tmpdir):
+    cache_dir = str(tmpdir.join('overpass'))
+    first = fetch_elements(server, cache_dir)
+    n_queries = len(server.queries)
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        os.path.basename(fetch.cache_path(query, server.url, cache_dir))
+        for query in set(server.queries))
+
+    # Every response comes from the cache, even with the server failing
+    server.failures = [503] * 100
+    second = fetch_elements(server, cache_dir)
+    assert len(server.queries) == n_queries
+    assert [ids(elements) for elements in second] == [
+        ids(elements) for elements in first]
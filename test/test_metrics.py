@@ -0,0 +1,31 @@
+'''Tests of the metrics of a run.'''
+import sys
+
+from crossify.metrics import Metrics
+
+
+def test_stage_without_resource_module(monkeypatch):
+    # The resource module only exists on Unix: memory use is unavailable
+    # elsewhere, but stages are still timed
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    metrics = Metrics()
+    for _ in range(2):
+        with metrics.stage('work') as stage:
+            stage['items'] = 3
+
+    record = metrics.stages['work']
+    assert record['calls'] == 2
+    assert record['items'] == 6
+    assert record['cpu_seconds'] >= 0
+    assert record['max_rss_mb'] is None
+    assert record['max_rss_increase_mb'] is None
+    assert record['max_rss_children_mb'] is None
+
+
+def test_stage_memory():
+    metrics = Metrics()
+    with metrics.stage('work'):
+        pass
+    record = metrics.stages['work']
+    assert record['max_rss_mb'] > 0
+    assert record['max_rss_increase_mb'] >= 0
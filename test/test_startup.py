@@ -0,0 +1,14 @@
+'''Tests that the command line application starts without loading heavy
+modules, so that --help and argument errors are fast.'''
+from crossify import benchmark
+
+
+def test_commands_start_without_heavy_modules():
+    # Every command timed by the benchmark exists and starts
+    startup = benchmark.startup_times(repeat=1)
+    assert len(startup['seconds']) == len(benchmark.STARTUP_COMMANDS) + 1
+    assert startup['heavy_modules'] == []
+
+
+def test_local_run():
+    assert benchmark.local_run_time(size=10, repeat=1) > 0